@@ -17,7 +17,11 @@
 """
 fwbackups package initialization.
 """
+import collections
+import fnmatch
 import os
+import re
+import selectors
 import sys
 import shutil
 import subprocess
@@ -30,6 +34,12 @@ __author__ = "Stewart Adam <s.adam@diffingo.com>"
 __version__ = "1.43.8-rc4"
 __license__ = "GPL-2.0-or-later"
 
+# Amount of a subprocess's error output kept by supervise(); the rest is dropped
+ERRORS_LIMIT = 64 * 1024
+# How often supervise() checks whether a subprocess exited when the platform
+# cannot notify it
+EXIT_POLL_INTERVAL = 0.5
+
 
 class fwbackupsError(Exception):
     """A generic Exception for the program."""
@@ -54,6 +64,46 @@ def escapeQuotes(string, noQuotes):
     return string
 
 
+class ExcludeMatcher:
+    """Matches paths against exclude patterns like tar and rsync do: patterns
+    are not anchored, so they may match the full path or any of its trailing
+    components. The patterns are compiled into a single regular expression
+    once, rather than globbed again for every file."""
+
+    def __init__(self, patterns):
+        self.patterns = [i for i in patterns if i]
+        if self.patterns:
+            self.regex = re.compile('(?:^|/)(?:%s)' % '|'.join([fnmatch.translate(i) for i in self.patterns]))
+        else:
+            self.regex = None
+
+    @classmethod
+    def fromOptions(cls, options):
+        """Returns the matcher for the Excludes and BackupHidden options"""
+        patterns = []
+        if not options['BackupHidden']:
+            patterns.append('.*')
+        if options['Excludes']:
+            patterns.extend(options['Excludes'].split('\n'))
+        return cls(patterns)
+
+    def matches(self, path):
+        """Checks whether path is excluded"""
+        if self.regex is None:
+            return False
+        if os.sep != '/':
+            path = path.replace(os.sep, '/')
+        return self.regex.search(path) is not None
+
+
+def excludeMatcher(excludes):
+    """Returns excludes if it already is an ExcludeMatcher, or one for the list
+    of patterns excludes"""
+    if isinstance(excludes, ExcludeMatcher):
+        return excludes
+    return ExcludeMatcher(excludes or [])
+
+
 def execute(*args, **kwargs):
     """Execute a command, wait for it to finish"""
     sub = executeSub(*args, **kwargs)
@@ -88,6 +138,128 @@ def executeSub(command, env=None, shell=False, stdoutfd=None, text=True):
     return sub
 
 
+class RingBuffer:
+    """Keeps the last size bytes written to it"""
+
+    def __init__(self, size):
+        self.size = size
+        self.chunks = collections.deque()
+        self.length = 0
+        self.truncated = False
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.length += len(data)
+        while self.length > self.size:
+            excess = self.length - self.size
+            if len(self.chunks[0]) <= excess:
+                self.length -= len(self.chunks.popleft())
+            else:
+                self.chunks[0] = self.chunks[0][excess:]
+                self.length -= excess
+            self.truncated = True
+
+    def getvalue(self):
+        return self.chunks[0][:0].join(self.chunks) if self.chunks else ''
+
+
+def _readIO(pid):
+    """Returns the bytes read and written by process pid and its children,
+    or None if the system does not report them"""
+    try:
+        with open('/proc/%i/io' % pid, 'r') as fh:
+            fields = dict([line.split(':') for line in fh.read().splitlines()])
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def supervise(sub, limit=ERRORS_LIMIT):
+    """Waits for the subprocess sub, started by executeSub(), to exit without
+    polling. Only the last limit bytes of its error output are kept. Returns its
+    exit status, its error output and a dictionary describing the resources it
+    and its children used, or None where this cannot be measured."""
+    errors = RingBuffer(limit)
+    if constants.MSWINDOWS:
+        # pipes cannot be selected on; read the errors until the process exits
+        for data in iter(lambda: sub.stderr.read(65536), ''):
+            errors.write(data)
+        return sub.wait(), errors.getvalue(), None
+    selector = selectors.DefaultSelector()
+    errorfd = sub.stderr.fileno()
+    selector.register(errorfd, selectors.EVENT_READ)
+    pidfd = None
+    if hasattr(os, 'pidfd_open'):
+        try:
+            pidfd = os.pidfd_open(sub.pid)
+            selector.register(pidfd, selectors.EVENT_READ)
+        except OSError:
+            pidfd = None
+    try:
+        while True:
+            exited = False
+            events = selector.select(None if pidfd is not None else EXIT_POLL_INTERVAL)
+            for key, mask in events:
+                if key.fd == errorfd:
+                    data = os.read(errorfd, 65536)
+                    if data:
+                        errors.write(data)
+                    else:
+                        selector.unregister(errorfd)
+                else:
+                    exited = True
+            if pidfd is None or exited or errorfd not in selector.get_map():
+                # The process stays a zombie until waited on, so its I/O
+                # counters can still be read
+                io = _readIO(sub.pid)
+                pid, status, rusage = os.wait4(sub.pid, 0 if exited else os.WNOHANG)
+                if pid:
+                    break
+        # collect what is left in the pipe
+        if errorfd in selector.get_map():
+            os.set_blocking(errorfd, False)
+            try:
+                for data in iter(lambda: os.read(errorfd, 65536), b''):
+                    errors.write(data)
+            except BlockingIOError:
+                pass
+    finally:
+        selector.close()
+        if pidfd is not None:
+            os.close(pidfd)
+    sub.returncode = os.waitstatus_to_exitcode(status)
+    maxrss = rusage.ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss //= 1024  # bytes rather than kilobytes
+    if io is None:
+        # blocks of 512 bytes actually read from or written to disk
+        io = (rusage.ru_inblock * 512, rusage.ru_oublock * 512)
+    usage = {'cpu': rusage.ru_utime + rusage.ru_stime,
+             'maxrss': maxrss,
+             'read': io[0],
+             'written': io[1]}
+    output = errors.getvalue()
+    if isinstance(output, bytes):
+        output = output.decode(errors='replace')
+    if errors.truncated:
+        output = '...\n' + output
+    return sub.returncode, output, usage
+
+
+def niceThread(increment):
+    """Adjusts the niceness of the calling thread by increment. Only Linux
+    schedules threads individually; elsewhere this does nothing so that the rest
+    of the program (e.g. the GUI) keeps its priority."""
+    if not constants.LINUX or not increment:
+        return
+    import threading
+    tid = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, os.getpriority(os.PRIO_PROCESS, tid) + increment)
+    except OSError:
+        pass
+
+
 def kill(PID, signal):
     """Effectively kill a process (win32 too!)"""
     # Thank you cookbook...
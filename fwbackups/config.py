@@ -214,7 +214,20 @@ class BackupSetConf:
         config["Options"]["BackupHidden"] = 1
         config["Options"]["SingleFilesystem"] = 1
         config["Options"]["Incremental"] = 0
+        config["Options"]["FullBackupEvery"] = 7
         config["Options"]["Engine"] = "tar"
+        config["Options"]["CompressionLevel"] = 0
+        config["Options"]["CompressionWorkers"] = 0
+        config["Options"]["StreamToRemote"] = 1
+        config["Options"]["PathWorkers"] = 1
+        config["Options"]["TransferConcurrency"] = 8
+        config["Options"]["UploadStripes"] = 1
+        config["Options"]["VerifyUploads"] = 0
+        config["Options"]["TransportCompression"] = 'auto'
+        config["Options"]["TransportCiphers"] = ''
+        config["Options"]["TransportWindowSize"] = 0
+        config["Options"]["TransportPacketSize"] = 0
+        config["Options"]["TransportRekeyBytes"] = 0
         config["Options"]["Sparse"] = 0
         config["Options"]["Nice"] = 0
         config["Options"]["Excludes"] = ""
@@ -495,6 +508,18 @@ class OneTimeConf:
         config["Options"]["BackupHidden"] = 1
         config["Options"]["Incremental"] = 0
         config["Options"]["Engine"] = "tar"
+        config["Options"]["CompressionLevel"] = 0
+        config["Options"]["CompressionWorkers"] = 0
+        config["Options"]["StreamToRemote"] = 1
+        config["Options"]["PathWorkers"] = 1
+        config["Options"]["TransferConcurrency"] = 8
+        config["Options"]["UploadStripes"] = 1
+        config["Options"]["VerifyUploads"] = 0
+        config["Options"]["TransportCompression"] = 'auto'
+        config["Options"]["TransportCiphers"] = ''
+        config["Options"]["TransportWindowSize"] = 0
+        config["Options"]["TransportPacketSize"] = 0
+        config["Options"]["TransportRekeyBytes"] = 0
         config["Options"]["Sparse"] = 0
         config["Options"]["Nice"] = 0
         config["Options"]["Excludes"] = ""
@@ -632,6 +657,7 @@ class RestoreConf:
         config["Options"]["RemoteUsername"] = ''
         config["Options"]["RemotePassword"] = ''
         config["Options"]["RemoteSource"] = ''
+        config["Options"]["TransferConcurrency"] = 8
         self.__config.importDict(config)
 
     def __validate(self, strictValidation=False):
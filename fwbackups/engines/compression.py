@@ -0,0 +1,361 @@
+# Copyright (C) 2023 Stewart Adam
+# This file is part of fwbackups.
+
+# fwbackups is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# fwbackups is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with fwbackups; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+Compression and decompression of the tar engines' archives.
+"""
+import bz2
+import collections
+import functools
+import gzip
+import os
+import subprocess
+import tarfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import fwbackups
+from fwbackups import shutil_modded
+from fwbackups.engines import EngineError
+
+# python-zstandard is optional; without it the zstd executable is used instead
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Input block sizes. bzip2 works on 900k blocks internally, so splitting there
+# costs nothing; gzip members are independent so larger blocks compress better.
+GZIP_BLOCKSIZE = 1024 * 1024
+BZ2_BLOCKSIZE = 900 * 1000
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+GZIP_MAGIC = b'\x1f\x8b'
+BZ2_MAGIC = b'BZh'
+# Compression levels: (minimum, maximum, default)
+LEVELS = {'tar.gz': (1, 9, 6),
+          'tar.bz2': (1, 9, 9),
+          'tar.zst': (1, 22, 3)}
+
+
+def defaultWorkers():
+    """Returns the number of CPUs available to this process"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def compressionLevel(engine, level):
+    """Returns level clamped to the range supported by engine, or the default
+    level of engine if level is 0"""
+    minimum, maximum, default = LEVELS[engine]
+    if not level:
+        return default
+    return max(minimum, min(level, maximum))
+
+
+class ParallelCompressor:
+    """A write-only file object that compresses independent blocks on a pool of
+    worker threads and writes them, in order, to fileobj.
+
+    Each block is a complete gzip member or bzip2 stream. The concatenation is a
+    standard multi-member gzip or multi-stream bzip2 file which gzip, bzip2 and
+    tar -x read as a single stream. zlib and bz2 release the GIL while they
+    compress, so the workers run truly in parallel. At most two blocks per
+    worker are held in memory at any time."""
+
+    def __init__(self, fileobj, compress, blocksize, workers=0):
+        self.fileobj = fileobj
+        self.compress = compress
+        self.blocksize = blocksize
+        self.workers = workers if workers > 0 else defaultWorkers()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.closed = False
+
+    def write(self, data):
+        """Queues data for compression"""
+        if self.closed:
+            raise ValueError('write to closed file')
+        self.buffer += data
+        while len(self.buffer) >= self.blocksize:
+            block = bytes(self.buffer[:self.blocksize])
+            del self.buffer[:self.blocksize]
+            self.submit(block)
+        return len(data)
+
+    def submit(self, block):
+        """Hands block to the pool, first writing out finished blocks if too
+        many are in flight"""
+        while len(self.pending) >= self.workers * 2:
+            self.fileobj.write(self.pending.popleft().result())
+        self.pending.append(self.executor.submit(self.compress, block))
+
+    def close(self):
+        """Compresses any remaining data and writes out all blocks. The
+        underlying file object is left open."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.buffer or not self.pending:
+                # an empty input still needs one valid (empty) member
+                self.submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+        finally:
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown(wait=True)
+
+    def abort(self):
+        """Discards any data not yet written"""
+        self.closed = True
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=True)
+
+
+class _Uncompressed:
+    """Writes archive data to fileobj as it is"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write(self, data):
+        return self.fileobj.write(data)
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class ZstdCompressor:
+    """A write-only file object compressing to fileobj as a zstd frame using the
+    multi-threaded compressor from python-zstandard"""
+
+    def __init__(self, fileobj, level, workers):
+        compressor = zstandard.ZstdCompressor(level=level, threads=workers)
+        self.writer = compressor.stream_writer(fileobj, closefd=False)
+
+    def write(self, data):
+        return self.writer.write(data)
+
+    def close(self):
+        self.writer.close()
+
+    def abort(self):
+        pass
+
+
+class ExternalCompressor:
+    """A write-only file object piping data through an external compressor such
+    as zstd. Its output is copied to fileobj from a separate thread."""
+
+    def __init__(self, fileobj, command):
+        self.fileobj = fileobj
+        self.error = None
+        self.sub = fwbackups.executeSub(command, stdoutfd=subprocess.PIPE, text=False)
+        self.thread = threading.Thread(target=self.__copyOutput)
+        self.thread.start()
+
+    def __copyOutput(self):
+        try:
+            while True:
+                buf = self.sub.stdout.read(shutil_modded.COPY_BUFSIZE)
+                if not buf:
+                    break
+                self.fileobj.write(buf)
+        except BaseException as error:
+            self.error = error
+            # don't leave the compressor blocked on a full pipe
+            self.sub.kill()
+
+    def write(self, data):
+        try:
+            self.sub.stdin.write(data)
+        except BrokenPipeError:
+            self.close()
+            raise EngineError('Compressor `%s\' exited early' % self.sub.args[0])
+        return len(data)
+
+    def close(self):
+        try:
+            self.sub.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.thread.join()
+        retval = self.sub.wait()
+        if self.error is not None:
+            raise self.error
+        if retval != 0:
+            raise EngineError('Compressor exited with status %s: %s' % (retval, self.sub.stderr.read().decode(errors='replace')))
+
+    def abort(self):
+        self.sub.kill()
+        self.thread.join()
+        self.sub.wait()
+
+
+def openCompressor(fileobj, engine, workers=0, level=0):
+    """Returns a file object which writes the archive data for engine to fileobj,
+    compressing it as required. The returned object must be closed to flush the
+    compressed data, or aborted if the archive is being abandoned; neither
+    closes fileobj."""
+    if engine == 'tar':
+        return _Uncompressed(fileobj)
+    level = compressionLevel(engine, level)
+    if workers <= 0:
+        workers = defaultWorkers()
+    if engine == 'tar.gz':
+        # A fixed mtime keeps the member headers identical between blocks
+        return ParallelCompressor(fileobj, functools.partial(gzip.compress, compresslevel=level, mtime=0), GZIP_BLOCKSIZE, workers)
+    elif engine == 'tar.bz2':
+        return ParallelCompressor(fileobj, functools.partial(bz2.compress, compresslevel=level), BZ2_BLOCKSIZE, workers)
+    elif engine == 'tar.zst':
+        if zstandard is not None:
+            return ZstdCompressor(fileobj, level, workers)
+        command = ['zstd', '-q', '-c', '-%i' % level, '-T%i' % workers]
+        if level > 19:
+            command.insert(1, '--ultra')
+        return ExternalCompressor(fileobj, command)
+    raise EngineError('Unknown archive engine `%s\'' % engine)
+
+
+class ExternalDecompressor:
+    """A read-only file object returning the output of an external decompressor
+    such as zstd, which is fed from fileobj by a separate thread."""
+
+    def __init__(self, fileobj, command):
+        self.fileobj = fileobj
+        self.error = None
+        self.sub = fwbackups.executeSub(command, stdoutfd=subprocess.PIPE, text=False)
+        self.thread = threading.Thread(target=self.__copyInput)
+        self.thread.start()
+
+    def __copyInput(self):
+        try:
+            while True:
+                buf = self.fileobj.read(shutil_modded.COPY_BUFSIZE)
+                if not buf:
+                    break
+                self.sub.stdin.write(buf)
+        except BrokenPipeError:
+            pass  # the reader stopped early
+        except BaseException as error:
+            self.error = error
+        finally:
+            try:
+                self.sub.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def read(self, length=-1):
+        buf = self.sub.stdout.read(length)
+        if not buf:
+            if self.error is not None:
+                raise self.error
+            if self.sub.wait() != 0:
+                raise EngineError('Decompressor exited with status %s: %s' % (self.sub.returncode, self.sub.stderr.read().decode(errors='replace')))
+        return buf
+
+    def close(self):
+        self.sub.stdout.close()
+        if self.sub.poll() is None:
+            self.sub.kill()
+        self.thread.join()
+        self.sub.wait()
+
+
+class ArchiveReader(tarfile.TarFile):
+    """A TarFile which also closes the decompressor it reads from, if any.
+    tarfile recreates the holes of GNU sparse members; the others are written
+    as they are."""
+    decompressor = None
+
+    def close(self):
+        try:
+            tarfile.TarFile.close(self)
+        finally:
+            if self.decompressor is not None:
+                self.decompressor.close()
+                self.decompressor = None
+
+
+class _Peeked:
+    """A read-only file object returning head, which was already read from the
+    start of fileobj, followed by the rest of fileobj"""
+
+    def __init__(self, fileobj, head):
+        self.fileobj = fileobj
+        self.head = head
+
+    def read(self, length=-1):
+        head, self.head = self.head, b''
+        if length < 0:
+            return head + self.fileobj.read()
+        if len(head) > length:
+            head, self.head = head[:length], head[length:]
+            return head
+        return head + self.fileobj.read(length - len(head))
+
+
+def openArchive(fileobj, stream=False):
+    """Opens the archive in fileobj for reading, detecting its compression. The
+    returned ArchiveReader does not close fileobj.
+
+    If stream is True fileobj is only read from start to end, never seeked,
+    and the members must be read in order."""
+    magic = fileobj.read(len(ZSTD_MAGIC))
+    if stream:
+        fileobj = _Peeked(fileobj, magic)
+    else:
+        fileobj.seek(0)
+    if magic == ZSTD_MAGIC:
+        # tarfile does not know zstd
+        if zstandard is not None:
+            decompressor = zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True, closefd=False)
+        else:
+            decompressor = ExternalDecompressor(fileobj, ['zstd', '-q', '-d', '-c'])
+        return _openStream(decompressor)
+    if not stream:
+        return ArchiveReader.open(fileobj=fileobj, mode='r:*')
+    # tarfile's own streams stop at the end of the first gzip member or bzip2
+    # stream, but ParallelCompressor writes many
+    if magic.startswith(GZIP_MAGIC):
+        return _openStream(gzip.GzipFile(fileobj=fileobj, mode='rb'))
+    if magic.startswith(BZ2_MAGIC):
+        return _openStream(bz2.BZ2File(fileobj, 'rb'))
+    return ArchiveReader.open(fileobj=fileobj, mode='r|')
+
+
+def _openStream(decompressor):
+    """Returns an ArchiveReader for the uncompressed archive read from
+    decompressor, which it closes when it is closed"""
+    try:
+        archive = ArchiveReader.open(fileobj=decompressor, mode='r|')
+    except BaseException:
+        decompressor.close()
+        raise
+    archive.decompressor = decompressor
+    return archive
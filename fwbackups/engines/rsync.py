@@ -17,3 +17,163 @@
 """
 Functions to make the rsync backend work.
 """
+import json
+import os
+import stat
+
+import fwbackups
+from fwbackups.i18n import _
+from fwbackups import sftp
+
+
+class Manifest:
+    """The size, modification time and mode of the files uploaded by the last
+    remote backup of a set, used to upload only the files which changed.
+
+    The manifest is saved as JSON. A backup which did not complete still saves
+    what it uploaded, so the next one carries on from there."""
+
+    def __init__(self, path):
+        self.path = path
+        # name of the remote backup the files were uploaded to
+        self.backup = None
+        # path -> state when last uploaded, or None if it must be uploaded again
+        self.files = {}
+        self.current = {}
+        self.name = None
+        try:
+            with open(path, 'r', encoding='utf-8') as fh:
+                data = json.load(fh)
+            self.backup = data['backup']
+            self.files = data['files']
+        except (OSError, ValueError, KeyError, TypeError):
+            # missing or damaged; everything will be uploaded again
+            self.backup, self.files = None, {}
+
+    def begin(self, name, reuse=True):
+        """Starts the backup called name. Unless reuse is True, the files of
+        the previous backup are not available and everything is uploaded."""
+        if not reuse:
+            self.files = {}
+        self.name = name
+        self.current = {}
+
+    def changed(self, path, st):
+        """Records the state of path and returns True if it changed since the
+        last backup"""
+        state = [st.st_size, st.st_mtime, st.st_mode]
+        self.current[path] = state
+        return self.files.get(path) != state
+
+    def forget(self, path):
+        """Makes sure path is uploaded again next time"""
+        self.current[path] = None
+
+    def deleted(self):
+        """Returns the paths which were removed since the last backup"""
+        return sorted([i for i in self.files if i not in self.current])
+
+    def save(self, complete=True):
+        """Saves the manifest of the backup. If it did not complete, the paths it
+        did not get to keep their previous state."""
+        if complete:
+            files = self.current
+        else:
+            files = dict(self.files)
+            files.update(self.current)
+        temp = '%s.tmp' % self.path
+        with open(temp, 'w', encoding='utf-8') as fh:
+            json.dump({'backup': self.name, 'files': files}, fh)
+        os.replace(temp, self.path)
+
+
+def remotePath(root, path):
+    """Returns where the local path is stored under root on the remote host"""
+    return os.path.normpath(root + os.sep + path)
+
+
+def removeRemote(sftpClient, path):
+    """Removes the file, link or folder path from the remote host, if it exists"""
+    try:
+        mode = sftpClient.lstat(path).st_mode
+    except IOError:
+        return
+    if stat.S_ISDIR(mode):
+        sftp.rmtree(sftpClient, path)
+    else:
+        sftp.removeFile(sftpClient, path)
+
+
+def replaceRemote(sftpClient, path, remote):
+    """Uploads the local file or link path as remote. The old remote file is
+    removed first rather than written over: an older backup may share it
+    through a hard link."""
+    try:
+        sftpClient.remove(remote)
+    except IOError:
+        pass
+    if os.path.islink(path):
+        sftpClient.symlink(os.readlink(path), remote)
+    else:
+        sftp.uploadFile(sftpClient, path, remote)
+
+
+def syncPath(sftpClient, src, root, manifest, symlinks=False, excludes=[], uploader=None):
+    """Uploads the files in src (local) which changed since the last backup to
+    the same path under root (remote). Uploads are handed to uploader, an
+    sftp.TransferPool, if given. Returns a list of errors."""
+    errors = []
+    excludes = fwbackups.excludeMatcher(excludes)
+    if uploader is None:
+        uploader = sftp.TransferPool(sftpClient)
+    src = os.path.normpath(src)
+    sftp.mkdir_p(sftpClient, remotePath(root, os.path.dirname(src)))
+    pending = [src]
+    while pending:
+        path = pending.pop()
+        if excludes.matches(path):
+            continue
+        remote = remotePath(root, path)
+        try:
+            st = os.lstat(path) if symlinks else os.stat(path)
+            previous = manifest.files.get(path)
+            changed = manifest.changed(path, st)
+            if stat.S_ISDIR(st.st_mode):
+                if changed:
+                    try:
+                        if not stat.S_ISDIR(sftpClient.lstat(remote).st_mode):
+                            removeRemote(sftpClient, remote)
+                            sftp.mkdir(sftpClient, remote)
+                    except IOError:
+                        sftp.mkdir(sftpClient, remote)
+                # files may change without changing their folder
+                pending.extend([os.path.join(path, i) for i in sorted(os.listdir(path), reverse=True)])
+            elif not changed:
+                continue
+            elif stat.S_ISLNK(st.st_mode) or stat.S_ISREG(st.st_mode):
+                manifest.forget(path)
+                if previous is not None and stat.S_ISDIR(previous[2]):
+                    removeRemote(sftpClient, remote)
+                uploader.submit('%s --> %s' % (path, remote), replaceRemote, path, remote,
+                                done=lambda path=path, st=st: manifest.changed(path, st))
+            else:
+                manifest.forget(path)
+                errors.append(_('`%s\' is not a file, folder or link! Skipping.') % path)
+        except (IOError, os.error) as reason:
+            manifest.forget(path)
+            errors.append('%s --> %s: %s' % (path, remote, reason))
+    return errors
+
+
+def removeDeleted(sftpClient, root, manifest):
+    """Removes the files deleted since the last backup from under root (remote).
+    Returns a list of errors."""
+    errors = []
+    # children before their parents
+    for path in reversed(manifest.deleted()):
+        remote = remotePath(root, path)
+        try:
+            removeRemote(sftpClient, remote)
+        except (IOError, os.error) as reason:
+            errors.append('%s: %s' % (remote, reason))
+    return errors
@@ -17,3 +17,319 @@
 """
 Functions to make the tar backend work.
 """
+import io
+import json
+import os
+import stat
+import tarfile
+import time
+
+import fwbackups
+from fwbackups import shutil_modded
+from fwbackups.i18n import _
+
+# Members describing an incremental archive. The header comes first so restores
+# can find the archive's place in its chain without reading the whole archive;
+# the list of deleted files is only known once everything else was archived.
+INCREMENTAL_HEADER = '.fwbackups-incremental'
+INCREMENTAL_DELETED = '.fwbackups-deleted'
+
+
+class _MemberReader(io.RawIOBase):
+    """File-like object producing the data of an archive member: an optional
+    header (such as a GNU sparse map) followed by the given regions of fh.
+
+    tarfile expects exactly the size recorded in the member header, so like tar
+    a file that shrinks or fails to read is padded with zeros rather than
+    corrupting the rest of the archive. The error is kept in self.error."""
+
+    def __init__(self, fh, extents, header=b''):
+        io.RawIOBase.__init__(self)
+        self.__fh = fh
+        self.__header = header
+        self.__extents = list(extents)
+        self.__remaining = 0
+        self.error = None
+
+    def readable(self):
+        return True
+
+    def read(self, length=-1):
+        if length < 0:
+            length = shutil_modded.COPY_BUFSIZE
+        chunks = []
+        while length > 0:
+            if self.__header:
+                buf = self.__header[:length]
+                self.__header = self.__header[len(buf):]
+            else:
+                if not self.__remaining:
+                    if not self.__extents:
+                        break
+                    offset, self.__remaining = self.__extents.pop(0)
+                    if self.error is None:
+                        self.__fh.seek(offset)
+                buf = b''
+                if self.error is None:
+                    try:
+                        buf = self.__fh.read(min(length, self.__remaining))
+                        if not buf:
+                            self.error = _('File shrank; padding with zeros')
+                    except OSError as error:
+                        self.error = error.strerror
+                if not buf:
+                    buf = tarfile.NUL * min(length, self.__remaining)
+                self.__remaining -= len(buf)
+            chunks.append(buf)
+            length -= len(buf)
+        return b''.join(chunks)
+
+
+def memberName(path):
+    """Returns the name tarfile gives to the member archiving path"""
+    path = os.path.splitdrive(path)[1].replace(os.sep, '/')
+    return path.lstrip('/')
+
+
+class Snapshot:
+    """The state of the files in the previous archives of a set, used to archive
+    only the files which changed since the last backup.
+
+    Each archive of a chain holds what changed since the archive before it, up
+    to the next full (level 0) archive. The snapshot is saved as JSON and must
+    only be saved once the archive was written successfully."""
+
+    def __init__(self, path):
+        self.path = path
+        self.level = 0
+        # name of the last archive written, which the next one builds upon
+        self.last = None
+        # archive name -> name of the archive it builds upon (None if full)
+        self.archives = {}
+        # path -> state when last archived
+        self.files = {}
+        self.current = {}
+        self.name = None
+        try:
+            with open(path, 'r', encoding='utf-8') as fh:
+                data = json.load(fh)
+            self.level = data['level']
+            self.last = data['last']
+            self.archives = data['archives']
+            self.files = data['files']
+        except (OSError, ValueError, KeyError, TypeError):
+            # missing or damaged; the next archive will be a full one
+            self.level, self.last, self.archives, self.files = 0, None, {}, {}
+
+    def begin(self, name, existing, fullEvery=0):
+        """Starts the archive called name. existing lists the archives still
+        present at the destination. A full archive is made if the last archive
+        is gone or, if fullEvery is above 0, once the chain holds fullEvery
+        archives."""
+        self.archives = dict([(i, j) for i, j in self.archives.items() if i in existing])
+        if self.last not in existing or (fullEvery > 0 and self.level + 1 >= fullEvery):
+            self.level = 0
+            self.last = None
+            self.files = {}
+        else:
+            self.level += 1
+        self.name = name
+        self.archives[name] = self.last
+        self.current = {}
+
+    def isFull(self):
+        """Returns True if the archive being written is a full archive"""
+        return self.level == 0
+
+    def changed(self, path, st):
+        """Records the state of path and returns True if it changed since the
+        last archive"""
+        state = [st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino]
+        self.current[path] = state
+        return self.files.get(path) != state
+
+    def forget(self, path):
+        """Makes sure path is archived again next time, for example after it
+        could not be read"""
+        self.current[path] = None
+
+    def deleted(self):
+        """Returns the paths which were removed since the last archive"""
+        return sorted([i for i in self.files if i not in self.current])
+
+    def header(self):
+        """Returns the description of the archive being written"""
+        return {'level': self.level, 'previous': self.last}
+
+    def required(self, names):
+        """Returns the set of archives needed to restore the archives in names"""
+        required = set()
+        for name in names:
+            while name is not None and name not in required:
+                required.add(name)
+                name = self.archives.get(name)
+        return required
+
+    def save(self):
+        """Saves the snapshot of the archive which was just written"""
+        data = {'level': self.level,
+                'last': self.name,
+                'archives': self.archives,
+                'files': self.current}
+        temp = '%s.tmp' % self.path
+        with open(temp, 'w', encoding='utf-8') as fh:
+            json.dump(data, fh)
+        os.replace(temp, self.path)
+
+
+class ArchiveWriter:
+    """Streams any number of paths into a single tar archive in one sequential
+    pass. Honours the same options parseCommand() translates into tar flags."""
+
+    def __init__(self, fileobj, options, ifCancel=None, snapshot=None):
+        """Writes the archive to the file object fileobj, which only needs to
+        support write(). ifCancel is called before each member is added. If a
+        Snapshot is given, only files which changed since the previous archive
+        are added."""
+        self.options = options
+        self.ifCancel = ifCancel
+        self.snapshot = snapshot
+        self.errors = []
+        self.excludes = fwbackups.ExcludeMatcher.fromOptions(options)
+        self.tar = tarfile.open(fileobj=fileobj, mode='w|', format=tarfile.PAX_FORMAT, bufsize=shutil_modded.COPY_BUFSIZE)
+        self.tar.dereference = options['FollowLinks']
+        if snapshot is not None:
+            self.addMetadata(INCREMENTAL_HEADER, json.dumps(snapshot.header()).encode('utf-8'))
+
+    def isExcluded(self, path):
+        """Checks path against the exclude patterns. Like tar, patterns are not
+        anchored: they may match the full path or any of its trailing components."""
+        return self.excludes.matches(path)
+
+    def add(self, path):
+        """Adds path, and its contents if recursion is enabled, to the archive"""
+        path = os.path.normpath(os.path.abspath(path))
+        if self.isExcluded(path):
+            return
+        try:
+            st = os.stat(path) if self.options['FollowLinks'] else os.lstat(path)
+        except OSError as error:
+            self.errors.append('%s: %s' % (path, error.strerror))
+            return
+        topDevice = st.st_dev
+        # directories whose contents were already archived; prevents loops
+        # when following symbolic links
+        visited = set()
+        pending = [(path, st)]
+        while pending:
+            if self.ifCancel is not None:
+                self.ifCancel()
+            path, st = pending.pop()
+            if self.snapshot is not None and not self.snapshot.changed(path, st) \
+                    and not stat.S_ISDIR(st.st_mode):
+                continue
+            if not self.addMember(path):
+                if self.snapshot is not None:
+                    self.snapshot.forget(path)
+                continue
+            if not stat.S_ISDIR(st.st_mode) or not self.options['Recursive']:
+                continue
+            if self.options['SingleFilesystem'] and st.st_dev != topDevice:
+                # like tar, archive the mount point but not what is mounted there
+                continue
+            if (st.st_dev, st.st_ino) in visited:
+                continue
+            visited.add((st.st_dev, st.st_ino))
+            children = []
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if self.isExcluded(entry.path):
+                            continue
+                        try:
+                            childst = entry.stat(follow_symlinks=self.options['FollowLinks'])
+                        except OSError as error:
+                            self.errors.append('%s: %s' % (entry.path, error.strerror))
+                            continue
+                        children.append((entry.path, childst))
+            except OSError as error:
+                self.errors.append('%s: %s' % (path, error.strerror))
+                continue
+            # The stack is LIFO; reverse so members are written in sorted order
+            children.sort(reverse=True)
+            pending.extend(children)
+
+    def addMember(self, path):
+        """Writes a single archive member for path. Returns False if it could not
+        be archived."""
+        try:
+            tarinfo = self.tar.gettarinfo(path)
+        except OSError as error:
+            self.errors.append('%s: %s' % (path, error.strerror))
+            return False
+        if tarinfo is None:
+            # sockets and other unsupported types; tar ignores them too
+            self.errors.append(_('`%s\' is not a file, folder or link! Skipping.') % path)
+            return False
+        if not tarinfo.isreg() or tarinfo.islnk():
+            self.tar.addfile(tarinfo)
+            return True
+        try:
+            with open(path, 'rb') as fh:
+                extents = None
+                if self.options['Sparse']:
+                    try:
+                        extents = [(start, end - start) for start, end in
+                                   shutil_modded.dataRanges(fh.fileno(), tarinfo.size)]
+                    except OSError:
+                        pass  # archived as if fully allocated
+                if extents is not None and sum([i[1] for i in extents]) < tarinfo.size:
+                    reader = self.sparseReader(tarinfo, fh, extents)
+                else:
+                    reader = _MemberReader(fh, [(0, tarinfo.size)])
+                self.tar.addfile(tarinfo, reader)
+        except OSError as error:
+            self.errors.append('%s: %s' % (path, error.strerror))
+            return False
+        if reader.error is not None:
+            self.errors.append('%s: %s' % (path, reader.error))
+            if self.snapshot is not None:
+                self.snapshot.forget(path)
+        return True
+
+    def sparseReader(self, tarinfo, fh, extents):
+        """Turns tarinfo into a GNU sparse (format 1.0) member and returns a reader
+        producing its data: the sparse map followed by the regions holding data"""
+        name = tarinfo.name
+        if not extents or sum(extents[-1]) < tarinfo.size:
+            # tar only learns about a trailing hole from an empty final region
+            extents = extents + [(tarinfo.size, 0)]
+        sparsemap = ['%d' % len(extents)]
+        for offset, length in extents:
+            sparsemap.extend(['%d' % offset, '%d' % length])
+        sparsemap = ('\n'.join(sparsemap) + '\n').encode('ascii')
+        sparsemap += tarfile.NUL * (-len(sparsemap) % tarfile.BLOCKSIZE)
+        tarinfo.pax_headers = {'GNU.sparse.major': '1',
+                               'GNU.sparse.minor': '0',
+                               'GNU.sparse.name': name,
+                               'GNU.sparse.realsize': str(tarinfo.size)}
+        head, tail = os.path.split(name)
+        tarinfo.name = os.path.join(head, 'GNUSparseFile.0', tail)
+        tarinfo.size = len(sparsemap) + sum([i[1] for i in extents])
+        return _MemberReader(fh, extents, sparsemap)
+
+    def addMetadata(self, name, data):
+        """Adds a member called name holding data"""
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.size = len(data)
+        tarinfo.mtime = time.time()
+        tarinfo.mode = 0o600
+        self.tar.addfile(tarinfo, io.BytesIO(data))
+
+    def close(self):
+        """Writes the end-of-archive marker. The underlying file object is left
+        open."""
+        if self.snapshot is not None:
+            deleted = [memberName(i) for i in self.snapshot.deleted()]
+            self.addMetadata(INCREMENTAL_DELETED, '\n'.join(deleted).encode('utf-8'))
+        self.tar.close()
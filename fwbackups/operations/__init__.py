@@ -59,15 +59,16 @@ class Common:
     def cancelOperation(self):
         """Requests the current operation stops as soon as possible"""
         self.logger.logmsg('INFO', _('Canceling the current operation!'))
+        # set first, so that waitForSub() stops a process it adds after this
+        self.toCancel = True
         if self.pids:
-            for process in self.pids:
+            for process in list(self.pids):
                 try:
                     self.logger.logmsg('DEBUG', _('Stopping process with ID %s') % process)
                     fwbackups.kill(process, 9)
                 except Exception as error:
                     self.logger.logmsg('WARNING', _('Could not stop process %s: %s') % (process, error))
                     continue
-        self.toCancel = True
 
     def ifCancel(self, fh=None):
         """Checks if another thread requested the operation be cancelled via
@@ -78,6 +79,31 @@ class Common:
                 fh.close()
             raise SystemExit
 
+    def waitForSub(self, sub):
+        """Waits for the subprocess sub to exit. It is stopped here if the
+        operation was already cancelled, and by cancelOperation() if it is
+        cancelled while sub runs. Logs the resources it used and returns its
+        exit status and the end of its error output."""
+        self.pids.append(sub.pid)
+        self.logger.logmsg('DEBUG', _('Starting subprocess with PID %s') % sub.pid)
+        try:
+            if self.toCancel:
+                self.logger.logmsg('DEBUG', _('Stopping process with ID %s') % sub.pid)
+                sub.kill()
+            retval, errors, usage = fwbackups.supervise(sub)
+        finally:
+            self.pids.remove(sub.pid)
+        self.logger.logmsg('DEBUG', _('Subprocess with PID %(a)s exited with status %(b)s' % {'a': sub.pid, 'b': retval}))
+        if usage is not None:
+            self.logger.logmsg('DEBUG', _('Subprocess with PID %(a)s used %(b).2fs of CPU time and %(c)i KiB of memory, '
+                                          'and read %(d)i and wrote %(e)i bytes') % {'a': sub.pid, 'b': usage['cpu'], 'c': usage['maxrss'],
+                                                                                     'd': usage['read'], 'e': usage['written']})
+        return retval, errors
+
+    def onConnectionLost(self, error, delay):
+        """Called before a transfer is retried on a new connection"""
+        self.logger.logmsg('WARNING', _('The connection to the server was lost (%(a)s); retrying in %(b)i seconds') % {'a': error, 'b': delay})
+
     def getProgress(self):
         """Get the progress of the operation. Returns the path number that is
         currently being backed up, the total number of paths and the current file
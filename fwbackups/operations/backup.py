@@ -18,12 +18,15 @@
 This file contains the logic for the backup operation
 """
 import base64
+import collections
 import os
 import re
 import sys
 import tempfile
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
 import fwbackups
@@ -33,6 +36,16 @@ from fwbackups import config
 from fwbackups import operations
 from fwbackups import shutil_modded
 from fwbackups import sftp
+from fwbackups.engines import compression
+from fwbackups.engines import rsync
+from fwbackups.engines import tar
+
+# Folder of a local destination where expired backups are deleted from
+TRASH_FOLDER = '.fwbackups-trash'
+# Threads deleting the trash; few, so that the backup keeps most of the disk
+TRASH_WORKERS = 4
+# Entries estimateSize() looks at in each path before it extrapolates
+ESTIMATE_ENTRIES = 1000
 
 
 class BackupStatus(Enum):
@@ -50,6 +63,18 @@ class BackupOperation(operations.Common):
         """Initalizes the class. If no logger is specified, a new one will be
         created."""
         operations.Common.__init__(self, logger)
+        # Snapshot of the previous archive when making incremental tar archives
+        self.snapshot = None
+        # Previous backup to hard-link unchanged files to for incremental rsync
+        self.linkDest = None
+        # Files uploaded by the last incremental rsync backup to a remote host
+        self.manifest = None
+        # Guards the progress when several paths are backed up at once
+        self.progressLock = threading.Lock()
+        # Exclude patterns for the copies made in-process
+        self.excludes = None
+        # Deletes the expired backups while the new one is made
+        self.trashThread = None
 
     def getOptions(self, conf):
         """Loads all the configuration options from a restore configuration file and
@@ -62,6 +87,15 @@ class BackupOperation(operations.Common):
         else:
             options['RemotePort'] = int(options['RemotePort'])
         options['Nice'] = int(options['Nice'])
+        # Options added after 1.43.8 may be missing from older configurations
+        options['CompressionWorkers'] = int(options.get('CompressionWorkers', 0))
+        options['CompressionLevel'] = int(options.get('CompressionLevel', 0))
+        options['PathWorkers'] = max(1, int(options.get('PathWorkers', 1)))
+        options['TransferConcurrency'] = max(1, int(options.get('TransferConcurrency', 8)))
+        options['UploadStripes'] = max(1, int(options.get('UploadStripes', 1)))
+        # a striped upload needs the finished archive on the local disk
+        options['StreamToRemote'] = _bool(options.get('StreamToRemote', 1)) and options['UploadStripes'] < 2
+        options['VerifyUploads'] = _bool(options.get('VerifyUploads', 0))
         options['RemotePassword'] = base64.b64decode(options['RemotePassword']).decode('ascii')
         for option in ['Recursive', 'PkgListsToFile', 'DiskInfoToFile',
                        'BackupHidden', 'FollowLinks', 'Sparse', 'SingleFilesystem']:
@@ -134,6 +168,8 @@ class BackupOperation(operations.Common):
             command = 'rsync -g -o -p -t -R'
             if self.options['Incremental']:
                 command += ' -u --del'
+                if self.linkDest:
+                    command += " --link-dest='%s'" % fwbackups.escapeQuotes(self.linkDest, 1)
             if self.options['Recursive']:
                 command += ' -r'
             if not self.options['BackupHidden']:
@@ -149,32 +185,10 @@ class BackupOperation(operations.Common):
             if self.options['Excludes'] is not None and self.options['Excludes'] != "":
                 for i in self.options['Excludes'].split('\n'):
                     command += ' --exclude="%s"' % i
-        elif self.options['Engine'] == 'tar':
-            command = "tar rf '%s'" % fwbackups.escapeQuotes(self.dest, 1)
-        elif self.options['Engine'] == 'tar.gz':
-            # DON'T rfz - Can't use r (append) and z (gzip) together
-            command = "tar cfz '%s'" % fwbackups.escapeQuotes(self.dest, 1)
-        elif self.options['Engine'] == 'tar.bz2':
-            # DON'T rfz - Can't use r (append) and j (bzip2) together
-            command = "tar cfj '%s'" % fwbackups.escapeQuotes(self.dest, 1)
-        # --
-        if self.options['Engine'] in ['tar', 'tar.gz', 'tar.bz2']:  # they share command options
-            if not self.options['Recursive']:
-                command += ' --no-recursion'
-            if not self.options['BackupHidden']:
-                command += ' --exclude=.*'
-            if self.options['Sparse']:
-                command += ' -S'
-            if self.options['FollowLinks']:
-                command += ' -h'
-            if self.options['SingleFilesystem']:
-                if constants.DARWIN:
-                    self.logger.logmsg('ERROR', _('Do not cross filesystem boundaries was enabled, but MacOS tar does not support this. Disable this option in your backup configuration and try again.'))
-                    raise ValueError
-                command += ' --one-file-system'
-        if self.options['Excludes']:
-            for i in self.options['Excludes'].split('\n'):
-                command += ' --exclude="%s"' % i
+        else:
+            # The tar engines are archived in-process by writeArchive(); there
+            # is no command to run
+            return None
         # Finally...
         return command
 
@@ -200,7 +214,7 @@ class BackupOperation(operations.Common):
         thread = fwbackups.runFuncAsThread(sftp.testConnection,
                                            self.options['RemoteHost'], self.options['RemoteUsername'],
                                            self.options['RemotePassword'], self.options['RemotePort'],
-                                           self.options['RemoteFolder'])
+                                           self.options['RemoteFolder'], sftp.transportTuning(self.options))
         while thread.retval is None:
             time.sleep(0.1)
 
@@ -238,6 +252,192 @@ class BackupOperation(operations.Common):
 
             return False
 
+    def writeArchive(self, paths, fileobj):
+        """Streams all paths into a single tar archive written to fileobj"""
+        fwbackups.niceThread(self.options['Nice'])
+        writer = tar.ArchiveWriter(fileobj, self.options, self.ifCancel, self.snapshot)
+        for path in paths:
+            self.ifCancel()
+            self._current += 1
+            self.logger.logmsg('DEBUG', _('Backing up path %(a)i/%(b)i: %(c)s') % {'a': self._current, 'b': self._total, 'c': path})
+            if not os.path.lexists(path):
+                self.logger.logmsg('WARNING', _("Path %s is missing or cannot be read and will be excluded from the backup.") % path)
+                continue
+            writer.add(path)
+        writer.close()
+        # Like tar, unreadable files are reported but do not fail the backup
+        if writer.errors:
+            self.logger.logmsg('WARNING', _('Some files could not be added to the archive:\n%s') % '\n'.join(writer.errors))
+
+    def compressArchive(self, paths, fh):
+        """Writes the archive of all paths to fh, compressed as the engine
+        requires"""
+        compressor = compression.openCompressor(fh, self.options['Engine'], self.options['CompressionWorkers'], self.options['CompressionLevel'])
+        try:
+            self.writeArchive(paths, compressor)
+        except BaseException:
+            compressor.abort()
+            raise
+        compressor.close()
+
+    def streamArchive(self, paths):
+        """Writes the archive straight into its file on the remote host, without
+        staging it on the local disk"""
+        client, sftpClient = sftp.acquire(self.options['RemoteHost'], self.options['RemoteUsername'], self.options['RemotePassword'], self.options['RemotePort'],
+                                          tuning=sftp.transportTuning(self.options))
+        remote = os.path.join(self.options['RemoteFolder'], os.path.basename(self.dest))
+        self.logger.logmsg('DEBUG', _('Streaming archive to `%(a)s\' on %(b)s') % {'a': remote, 'b': self.options['RemoteHost']})
+        try:
+            sftp.mkdir_p(sftpClient, self.options['RemoteFolder'])
+            fh = sftpClient.open(remote, 'wb')
+            digest = sftp.UploadDigest() if self.options['VerifyUploads'] else None
+            try:
+                # Don't wait for each write to be acknowledged. The SSH window
+                # bounds the data in flight, so memory use stays constant.
+                fh.set_pipelined(True)
+                self.compressArchive(paths, fh if digest is None else sftp.DigestWriter(fh, digest))
+            finally:
+                fh.close()
+            if digest is not None:
+                self.verifyUpload(client, sftpClient, remote, digest)
+        except BaseException:
+            # don't leave a truncated archive looking like a backup
+            try:
+                sftp.removeFile(sftpClient, remote)
+            except Exception:
+                pass
+            raise
+        finally:
+            sftp.release(client, sftpClient)
+
+    def syncRemote(self, sftpClient, paths):
+        """Uploads the files which changed since the last backup to the remote
+        backup, which starts out as a copy of the previous one, and removes the
+        files which were deleted since"""
+        root = os.path.join(self.options['RemoteFolder'], os.path.basename(self.dest))
+        errors = []
+        complete = False
+        try:
+            uploader = sftp.TransferPool(sftpClient, self.options['TransferConcurrency'])
+            try:
+                for path in paths:
+                    if self.toCancel:
+                        break
+                    self._current += 1
+                    self.logger.logmsg('DEBUG', _('Backing up path %(a)i/%(b)i: %(c)s') % {'a': self._current, 'b': self._total, 'c': path})
+                    if not os.path.exists(path):
+                        self.logger.logmsg('WARNING', _("Path %s is missing or cannot be read and will be excluded from the backup.") % path)
+                        continue
+                    errors.extend(rsync.syncPath(sftpClient, path, root, self.manifest, symlinks=not self.options['FollowLinks'],
+                                                 excludes=self.excludes, uploader=uploader))
+            finally:
+                errors.extend(uploader.close())
+            if not self.toCancel:
+                errors.extend(rsync.removeDeleted(sftpClient, root, self.manifest))
+                complete = True
+        finally:
+            self.manifest.save(complete)
+        if errors:
+            self.logger.logmsg('WARNING', _('Could not copy some files due to errors:\n%s') % '\n'.join(errors))
+
+    def verifyUpload(self, client, sftpClient, remote, digest):
+        """Checks the uploaded file remote against the UploadDigest of the data
+        sent to it. A mismatch is logged and raised."""
+        try:
+            method = sftp.verifyUpload(client, sftpClient, remote, digest)
+        except IOError as error:
+            self.logger.logmsg('ERROR', _('The backup on the server does not match the data that was sent: %s') % error)
+            raise
+        self.logMatch(remote, digest, method)
+
+    def logMatch(self, remote, digest, method):
+        """Logs that the uploaded file remote was verified using method"""
+        self.logger.logmsg('DEBUG', _('Verified `%(a)s\' using %(b)s (SHA-256 %(c)s)') % {'a': remote, 'b': method, 'c': digest.hexdigest()})
+
+    def uploadArchive(self, client, sftpClient):
+        """Uploads the archive staged on the local disk, which is done when
+        StreamToRemote is off or UploadStripes is above 1, to the remote folder.
+        Large archives are sent in stripes over several connections and
+        verified once uploaded."""
+        stripes = self.options['UploadStripes']
+        remote = os.path.join(self.options['RemoteFolder'], os.path.basename(self.dest))
+        if stripes < 2 or os.path.getsize(self.dest) < sftp.STRIPE_THRESHOLD:
+            if not self.options['VerifyUploads']:
+                return sftp.put(sftpClient, self.dest, self.options['RemoteFolder'])
+            # hash the archive as it is sent rather than reading it twice
+            digest = sftp.UploadDigest()
+            sftp.mkdir_p(sftpClient, self.options['RemoteFolder'])
+            sftp.uploadFile(sftpClient, self.dest, remote, digest)
+            try:
+                self.verifyUpload(client, sftpClient, remote, digest)
+            except IOError:
+                sftp.removeFile(sftpClient, remote)
+                raise
+            return
+        sftp.mkdir_p(sftpClient, self.options['RemoteFolder'])
+        self.logger.logmsg('DEBUG', _('Uploading the archive over %i connections') % stripes)
+
+        def connect():
+            return sftp.connect(self.options['RemoteHost'], self.options['RemoteUsername'], self.options['RemotePassword'], self.options['RemotePort'],
+                                tuning=sftp.transportTuning(self.options))
+        try:
+            digest, method = sftp.putStriped(sftpClient, self.dest, remote, stripes, client=client, connect=connect)
+        except IOError as error:
+            self.logger.logmsg('ERROR', _('Could not upload the archive: %s') % error)
+            raise
+        self.logMatch(remote, digest, method)
+
+    def estimateSize(self, path):
+        """Returns a rough estimate of the size of the files in path, enough to
+        start the largest paths first. The tree is walked breadth first until
+        ESTIMATE_ENTRIES entries were seen; each folder left unexplored is
+        counted as the average explored one."""
+        try:
+            if not os.path.isdir(path) or os.path.islink(path):
+                return os.lstat(path).st_size
+        except OSError:
+            return 0
+        total = seen = explored = 0
+        pending = collections.deque([path])
+        while pending and seen < ESTIMATE_ENTRIES:
+            folder = pending.popleft()
+            explored += 1
+            try:
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        seen += 1
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        else:
+                            total += entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                pass
+        return total + total * len(pending) // explored
+
+    def backupPath(self, path, command):
+        """Copies a single path to the local destination. Returns False if an
+        error occurred."""
+        self.ifCancel()
+        with self.progressLock:
+            self._current += 1
+            current = self._current
+        if constants.MSWINDOWS:
+            # let's deal with real paths
+            self.logger.logmsg('DEBUG', _('Backing up path %(a)i/%(b)i: %(c)s' % {'a': current, 'b': self._total, 'c': path}))
+            shutil_modded.copytree_fullpaths(path, self.dest, excludes=self.excludes)
+            return True
+        # not constants.MSWINDOWS; UNIX/OS X can call rsync binary
+        path = fwbackups.escapeQuotes(path, 1)
+        self.logger.logmsg('DEBUG', _("Running command: nice -n %(a)i %(b)s %(c)s '%(d)s'" % {'a': self.options['Nice'], 'b': command, 'c': path, 'd': fwbackups.escapeQuotes(self.dest, 1)}))
+        sub = fwbackups.executeSub("nice -n %i %s '%s' '%s'" % (self.options['Nice'], command, path, fwbackups.escapeQuotes(self.dest, 1)), env=self.environment, shell=True)
+        retval, errors = self.waitForSub(sub)
+        # Something wrong?
+        if retval not in [constants.EXIT_STATUS_OK, 2]:
+            self.logger.logmsg('ERROR', 'An error occurred while backing up path \'%s\'.\nPlease check the error output below to determine if any files are incomplete or missing.' % str(path))
+            self.logger.logmsg('ERROR', _('Process exited with status %(a)s. Errors: %(b)s' % {'a': str(retval), 'b': errors}))
+            return False
+        return True
+
     def backupPaths(self, paths, command):
         """Does the actual copying dirty work"""
         # this is in common
@@ -247,193 +447,77 @@ class BackupOperation(operations.Common):
         self._total = len(paths)
         self._status = BackupStatus.BACKING_UP
         wasAnError = False
-        if self.options['Engine'] == 'tar':
-            if constants.MSWINDOWS:
-                self.logger.logmsg('INFO', _('Using %s on Windows: Cancel function will only take effect after a path has been completed.' % self.options['Engine']))
-                import tarfile
-                fh = tarfile.open(self.dest, 'w')
-                for path in paths:
-                    self.ifCancel()
-                    self._current += 1
-                    self.logger.logmsg('DEBUG', _('Backing up path %(a)i/%(b)i: %(c)s' % {'a': self._current, 'b': self._total, 'c': path}))
-                    fh.add(path, recursive=self.options['Recursive'])
-                fh.close()
-            else:  # not constants.MSWINDOWS
-                for path in paths:
-                    path = fwbackups.escapeQuotes(path, 1)
-                    self.ifCancel()
-                    self._current += 1
-                    self.logger.logmsg('DEBUG', _("Running command: nice -n %(a)i %(b)s '%(c)s'" % {'a': self.options['Nice'], 'b': command, 'c': path}))
-                    sub = fwbackups.executeSub("nice -n %i %s '%s'" % (self.options['Nice'], command, path), env=self.environment, shell=True)
-                    self.pids.append(sub.pid)
-                    self.logger.logmsg('DEBUG', _('Starting subprocess with PID %s') % sub.pid)
-                    # track stdout
-                    errors = []
-                    os.set_blocking(sub.stderr.fileno(), False)
-                    while sub.poll() in ["", None]:
-                        time.sleep(0.01)
-                        data = sub.stderr.readline()
-                        if data:
-                            errors += data
-                    self.pids.remove(sub.pid)
-                    retval = sub.poll()
-                    self.logger.logmsg('DEBUG', _('Subprocess with PID %(a)s exited with status %(b)s' % {'a': sub.pid, 'b': retval}))
-                    # Something wrong?
-                    if retval != constants.EXIT_STATUS_OK and retval != 2:
-                        wasAnError = True
-                        self.logger.logmsg('ERROR', 'An error occurred while backing up path \'%s\'.\nPlease check the error output below to determine if any files are incomplete or missing.' % str(path))
-                        self.logger.logmsg('ERROR', _('Process exited with status %(a)s. Errors: %(b)s' % {'a': str(retval), 'b': ''.join(errors)}))
-
-        elif self.options['Engine'] == 'tar.gz':
-            self._total = 1
-            if constants.MSWINDOWS:
-                self.logger.logmsg('INFO', _('Using %s on Windows: Cancel function will only take effect after a path has been completed.' % self.options['Engine']))
-                import tarfile
-                fh = tarfile.open(self.dest, 'w:gz')
-                for path in paths:
-                    self._current += 1
-                    self.ifCancel()
-                    self.logger.logmsg('DEBUG', _('Backing up path %(a)i/%(b)i: %(c)s' % {'a': self._current, 'b': self._total, 'c': path}))
-                    fh.add(path, recursive=self.options['Recursive'])
-                    self.logger.logmsg('DEBUG', _('Adding path `%s\' to the archive' % path))
-                fh.close()
-            else:  # not constants.MSWINDOWS
-                self._current = 1
-                escapedPaths = [fwbackups.escapeQuotes(i, 1) for i in paths]
-                # This is a fancy way for getting i = "'one' 'two' 'three'"
-                path = "'%s'" % "' '".join(escapedPaths)
-                self.logger.logmsg('INFO', _('Using %s: Must backup all paths at once - Progress notification will be disabled.' % self.options['Engine']))
-                self.logger.logmsg('DEBUG', _('Backing up path %(a)i/%(b)i: %(c)s') % {'a': self._current, 'b': self._total, 'c': path.replace("'", '')})
-                self.logger.logmsg('DEBUG', _("Running command: nice -n %(a)i %(b)s %(c)s" % {'a': self.options['Nice'], 'b': command, 'c': path}))
-                # Don't wrap i in quotes; we did this above already when mering the paths
-                sub = fwbackups.executeSub("nice -n %i %s %s" % (self.options['Nice'], command, path), env=self.environment, shell=True)
-                self.pids.append(sub.pid)
-                self.logger.logmsg('DEBUG', _('Starting subprocess with PID %s') % sub.pid)
-                # track stdout
-                errors = []
-                # use nonblocking I/O
-                os.set_blocking(sub.stderr.fileno(), False)
-                while sub.poll() in ["", None]:
-                    time.sleep(0.01)
-                    data = sub.stderr.readline()
-                    if data:
-                        errors += data
-                self.pids.remove(sub.pid)
-                retval = sub.poll()
-                self.logger.logmsg('DEBUG', _('Subprocess with PID %(a)s exited with status %(b)s' % {'a': sub.pid, 'b': retval}))
-                # Something wrong?
-                if retval != constants.EXIT_STATUS_OK and retval != 2:
-                    wasAnError = True
-                    self.logger.logmsg('ERROR', 'An error occurred while backing up path \'%s\'.\nPlease check the error output below to determine if any files are incomplete or missing.' % str(path))
-                    self.logger.logmsg('ERROR', _('Process exited with status %(a)s. Errors: %(b)s' % {'a': str(retval), 'b': ''.join(errors)}))
-
-        elif self.options['Engine'] == 'tar.bz2':
-            self._total = 1
-            if constants.MSWINDOWS:
-                self.logger.logmsg('INFO', _('Using %s on Windows: Cancel function will only take effect after a path has been completed.' % self.options['Engine']))
-                import tarfile
-                fh = tarfile.open(self.dest, 'w:bz2')
-                for path in paths:
-                    self._current += 1
-                    self.ifCancel()
-                    self.logger.logmsg('DEBUG', _('Backing up path %(a)i/%(b)i: %(c)s' % {'a': self._current, 'b': self._total, 'c': path}))
-                    fh.add(path, recursive=self.options['Recursive'])
-                    self.logger.logmsg('DEBUG', _('Adding path `%s\' to the archive' % path))
-                fh.close()
-            else:  # not constants.MSWINDOWS
-                self._current = 1
-                escapedPaths = [fwbackups.escapeQuotes(i, 1) for i in paths]
-                # This is a fancy way for getting i = "'one' 'two' 'three'"
-                path = "'%s'" % "' '".join(escapedPaths)
-                self.logger.logmsg('INFO', _('Using %s: Must backup all paths at once - Progress notification will be disabled.' % self.options['Engine']))
-                self.logger.logmsg('DEBUG', _('Backing up path %(a)i/%(b)i: %(c)s') % {'a': self._current, 'b': self._total, 'c': path})
-                self.logger.logmsg('DEBUG', _("Running command: nice -n %(a)i %(b)s %(c)s" % {'a': self.options['Nice'], 'b': command, 'c': path}))
-                # Don't wrap i in quotes; we did this above already when mering the paths
-                sub = fwbackups.executeSub("nice -n %i %s %s" % (self.options['Nice'], command, path), env=self.environment, shell=True)
-                self.pids.append(sub.pid)
-                self.logger.logmsg('DEBUG', _('Starting subprocess with PID %s') % sub.pid)
-                # track stdout
-                errors = []
-                # use nonblocking I/O
-                os.set_blocking(sub.stderr.fileno(), False)
-                while sub.poll() in ["", None]:
-                    time.sleep(0.01)
-                    data = sub.stderr.readline()
-                    if data:
-                        errors += data
-                self.pids.remove(sub.pid)
-                retval = sub.poll()
-                self.logger.logmsg('DEBUG', _('Subprocess with PID %(a)s exited with status %(b)s' % {'a': sub.pid, 'b': retval}))
-                # Something wrong?
-                if retval != constants.EXIT_STATUS_OK and retval != 2:
-                    wasAnError = True
-                    self.logger.logmsg('ERROR', 'An error occurred while backing up path \'%s\'.\nPlease check the error output below to determine if any files are incomplete or missing.' % str(path))
-                    self.logger.logmsg('ERROR', _('Process exited with status %(a)s. Errors: %(b)s' % {'a': str(retval), 'b': ''.join(errors)}))
+        self.excludes = fwbackups.ExcludeMatcher.fromOptions(self.options)
+        if self.options['Engine'] in ['tar', 'tar.gz', 'tar.bz2', 'tar.zst']:
+            if self.options['DestinationType'] == 'remote (ssh)' and self.options['StreamToRemote']:
+                self.streamArchive(paths)
+            else:
+                fh = open(self.dest, 'wb')
+                try:
+                    self.compressArchive(paths, fh)
+                finally:
+                    fh.close()
 
         elif self.options['Engine'] == 'rsync':
             # in this case, self.{folderdest,dest} both need to be created
             if self.options['DestinationType'] == 'remote (ssh)':
-                client, sftpClient = sftp.connect(self.options['RemoteHost'], self.options['RemoteUsername'], self.options['RemotePassword'], self.options['RemotePort'])
+                client, sftpClient = sftp.acquire(self.options['RemoteHost'], self.options['RemoteUsername'], self.options['RemotePassword'], self.options['RemotePort'],
+                                                  tuning=sftp.transportTuning(self.options))
                 self.logger.logmsg('DEBUG', _('Connected to SFTP server {RemoteHost}; backing up paths directly to remote host.').format(RemoteHost=self.options['RemoteHost']))
-                if not wasAnError:
-                    for path in paths:
-                        if self.toCancel:
-                            # Check if we need to cancel in between paths
-                            # If so, break and close the SFTP session
-                            # Immediately after, self.ifCancel() is run.
-                            break
-                        self._current += 1
-                        self.logger.logmsg('DEBUG', _('Backing up path %(a)i/%(b)i: %(c)s') % {'a': self._current, 'b': self._total, 'c': path})
-                        if not os.path.exists(path):
-                            self.logger.logmsg('WARNING', _("Path %s is missing or cannot be read and will be excluded from the backup.") % path)
-                        sftp.put(sftpClient, path, os.path.normpath(self.options['RemoteFolder'] + os.sep + os.path.basename(self.dest) + os.sep + os.path.dirname(path)), symlinks=not self.options['FollowLinks'], excludes=self.options['Excludes'].split('\n'))
-                sftpClient.close()
-                client.close()
+                try:
+                    if self.manifest is not None:
+                        self.syncRemote(sftpClient, paths)
+                    elif not wasAnError:
+                        for path in paths:
+                            if self.toCancel:
+                                # Check if we need to cancel in between paths
+                                # If so, break and close the SFTP session
+                                # Immediately after, self.ifCancel() is run.
+                                break
+                            self._current += 1
+                            self.logger.logmsg('DEBUG', _('Backing up path %(a)i/%(b)i: %(c)s') % {'a': self._current, 'b': self._total, 'c': path})
+                            if not os.path.exists(path):
+                                self.logger.logmsg('WARNING', _("Path %s is missing or cannot be read and will be excluded from the backup.") % path)
+                            sftp.put(sftpClient, path, os.path.normpath(self.options['RemoteFolder'] + os.sep + os.path.basename(self.dest) + os.sep + os.path.dirname(path)), symlinks=not self.options['FollowLinks'], excludes=self.excludes, concurrency=self.options['TransferConcurrency'])
+                finally:
+                    sftp.release(client, sftpClient)
             else:  # destination is local
-                for path in paths:
-                    self.ifCancel()
-                    self._current += 1
-                    if constants.MSWINDOWS:
-                        # let's deal with real paths
-                        self.logger.logmsg('DEBUG', _('Backing up path %(a)i/%(b)i: %(c)s' % {'a': self._current, 'b': self._total, 'c': path}))
-                        shutil_modded.copytree_fullpaths(path, self.dest)
-                    else:  # not constants.MSWINDOWS; UNIX/OS X can call rsync binary
-                        path = fwbackups.escapeQuotes(path, 1)
-                        self.logger.logmsg('DEBUG', _("Running command: nice -n %(a)i %(b)s %(c)s '%(d)s'" % {'a': self.options['Nice'], 'b': command, 'c': path, 'd': fwbackups.escapeQuotes(self.dest, 1)}))
-                        sub = fwbackups.executeSub("nice -n %i %s '%s' '%s'" % (self.options['Nice'], command, path, fwbackups.escapeQuotes(self.dest, 1)), env=self.environment, shell=True)
-                        self.pids.append(sub.pid)
-                        self.logger.logmsg('DEBUG', _('Starting subprocess with PID %s') % sub.pid)
-                        # track stdout
-                        errors = []
-                        # use nonblocking I/O
-                        os.set_blocking(sub.stderr.fileno(), False)
-                        while sub.poll() in ["", None]:
-                            time.sleep(0.01)
-                            data = sub.stderr.readline()
-                            if data:
-                                errors += data
-                        self.pids.remove(sub.pid)
-                        retval = sub.poll()
-                        self.logger.logmsg('DEBUG', _('Subprocess with PID %(a)s exited with status %(b)s' % {'a': sub.pid, 'b': retval}))
-                        # Something wrong?
-                        if retval not in [constants.EXIT_STATUS_OK, 2]:
+                workers = min(self.options['PathWorkers'], len(paths))
+                if workers > 1:
+                    # Largest paths first, so the workers finish at about the
+                    # same time
+                    paths = sorted(paths, key=self.estimateSize, reverse=True)
+                    self.logger.logmsg('DEBUG', _('Backing up %i paths at once') % workers)
+                    executor = ThreadPoolExecutor(max_workers=workers)
+                    futures = [executor.submit(self.backupPath, path, command) for path in paths]
+                    try:
+                        for future in futures:
+                            if not future.result():
+                                wasAnError = True
+                    finally:
+                        # stop at the first cancellation or unexpected error
+                        for future in futures:
+                            future.cancel()
+                        executor.shutdown(wait=True)
+                else:
+                    for path in paths:
+                        if not self.backupPath(path, command):
                             wasAnError = True
-                            self.logger.logmsg('ERROR', 'An error occurred while backing up path \'%s\'.\nPlease check the error output below to determine if any files are incomplete or missing.' % str(path))
-                            self.logger.logmsg('ERROR', _('Process exited with status %(a)s. Errors: %(b)s' % {'a': str(retval), 'b': ''.join(errors)}))
 
         self.ifCancel()
         # A test is included to ensure sure the archive actually exists, as if
         # wasAnError = True the archive might not even exist.
-        if self.options['Engine'].startswith('tar') and self.options['DestinationType'] == 'remote (ssh)':
+        if self.options['Engine'].startswith('tar') and self.options['DestinationType'] == 'remote (ssh)' \
+                and not self.options['StreamToRemote']:
             if not os.path.exists(self.dest):
                 self.logger.logmsg('WARN' if wasAnError else 'ERROR', _("Could not sent backup archive to remote server because temporary destination '{dest}' was not found").format(dest=self.dest))
                 wasAnError = True
             else:
                 self.logger.logmsg('DEBUG', _('Sending files to server via SFTP'))
                 self._status = BackupStatus.SENDING_TO_REMOTE
-                client, sftpClient = sftp.connect(self.options['RemoteHost'], self.options['RemoteUsername'], self.options['RemotePassword'], self.options['RemotePort'])
                 try:
-                    sftp.put(sftpClient, self.dest, self.options['RemoteFolder'])
+                    sftp.retry(self.options['RemoteHost'], self.options['RemoteUsername'], self.options['RemotePassword'], self.options['RemotePort'],
+                               self.uploadArchive, onRetry=self.onConnectionLost, tuning=sftp.transportTuning(self.options))
                     os.remove(self.dest)
                 except BaseException:
                     import sys
@@ -442,8 +526,6 @@ class BackupOperation(operations.Common):
                     self.logger.logmsg('DEBUG', _('Could not send file(s) or folder to server:'))
                     (etype, value, tb) = sys.exc_info()
                     self.logger.logmsg('DEBUG', ''.join(traceback.format_exception(etype, value, tb)))
-                sftpClient.close()
-                client.close()
 
         # finally, we do this
         self._current = self._total
@@ -478,6 +560,8 @@ class OneTimeBackupOperation(BackupOperation):
             self.dest += '.tar.gz'
         elif self.options['Engine'] == 'tar.bz2':
             self.dest += '.tar.bz2'
+        elif self.options['Engine'] == 'tar.zst':
+            self.dest += '.tar.zst'
 
     def start(self):
         """One-time backup"""
@@ -552,6 +636,8 @@ class SetBackupOperation(BackupOperation):
             self.dest += '.tar.gz'
         elif self.options['Engine'] == 'tar.bz2':
             self.dest += '.tar.bz2'
+        elif self.options['Engine'] == 'tar.zst':
+            self.dest += '.tar.zst'
 
     def getOptions(self, config, forceEnabled=False):
         """Subclass getOptions to handle options only in Set configs"""
@@ -561,6 +647,8 @@ class SetBackupOperation(BackupOperation):
         options['Enabled'] = forceEnabled or _bool(options['Enabled'])
         options['Incremental'] = _bool(options['Incremental'])
         options['OldToKeep'] = int(float(options['OldToKeep']))
+        # Options added after 1.43.8 may be missing from older configurations
+        options['FullBackupEvery'] = int(options.get('FullBackupEvery', 7))
         return options
 
     def tokens_replace(self, text, date, successful=None):
@@ -612,30 +700,96 @@ class SetBackupOperation(BackupOperation):
         # Execute the command
         self.logger.logmsg('INFO', _("Executing '%s' command") % cmd_type_str)
         sub = fwbackups.executeSub(command, env=self.environment, shell=True)
-        self.pids.append(sub.pid)
-        self.logger.logmsg('DEBUG', _('Starting subprocess with PID %s') % sub.pid)
-        # track stdout
-        errors = []
-        # use nonblocking I/O
-        os.set_blocking(sub.stderr.fileno(), False)
-        while sub.poll() in ["", None]:
-            time.sleep(0.01)
-            data = sub.stderr.readline()
-            if data:
-                errors += data
-        self.pids.remove(sub.pid)
-        retval = sub.poll()
+        retval, errors = self.waitForSub(sub)
         # Something wrong?
         if retval != constants.EXIT_STATUS_OK:
             self.logger.logmsg('ERROR', _('Command returned with a non-zero exit status!'))
-            self.logger.logmsg('ERROR', _('Process exited with status %(a)s. Errors: %(b)s' % {'a': str(retval), 'b': ''.join(errors)}))
+            self.logger.logmsg('ERROR', _('Process exited with status %(a)s. Errors: %(b)s' % {'a': str(retval), 'b': errors}))
+
+    def reuseRemoteBackup(self, client, sftpClient, oldbackups, expired):
+        """Turns the last remote backup into the new one, so only the files which
+        changed need to be uploaded. With OldToKeep above 0 the new backup is
+        a hard-linked copy made on the server, otherwise the last backup is
+        renamed. Returns the old backups which should still be removed."""
+        name = os.path.basename(self.dest)
+        previous = self.manifest.backup
+        if previous not in oldbackups:
+            self.logger.logmsg('DEBUG', _('No previous remote backup to reuse; uploading all files'))
+            self.manifest.begin(name, reuse=False)
+            return expired
+        last = os.path.join(self.options['RemoteFolder'], previous)
+        new = os.path.join(self.options['RemoteFolder'], name)
+        if previous == name:
+            pass  # ran again within the same minute
+        elif self.options['OldToKeep'] > 0:
+            self.logger.logmsg('DEBUG', _('Copying `%(a)s\' to `%(b)s\' on %(c)s') % {'a': last, 'b': new, 'c': self.options['RemoteHost']})
+            try:
+                retval, stdout, stderr = sftp.execute(client, "cp -al '%s' '%s'" % (fwbackups.escapeQuotes(last, 1), fwbackups.escapeQuotes(new, 1)))
+            except Exception as error:
+                retval, stderr = None, str(error)
+            # made behind the back of the SFTP session
+            sftp.metadataCache(sftpClient).forget(new)
+            if retval != 0:
+                # the server may only allow SFTP
+                self.logger.logmsg('WARNING', _('Could not copy the previous backup on the server; uploading all files. Error: %s') % stderr.strip())
+                sftp.remove(sftpClient, new)
+                self.manifest.begin(name, reuse=False)
+                return expired
+        else:
+            self.logger.logmsg('DEBUG', _('Moving `%(a)s\' to `%(b)s\' on %(c)s') % {'a': last, 'b': new, 'c': self.options['RemoteHost']})
+            sftpClient.rename(last, new)
+            sftp.metadataCache(sftpClient).forget(last)
+            sftp.metadataCache(sftpClient).forget(new)
+        self.manifest.begin(name)
+        return [i for i in expired if i != previous]
+
+    def trashBackup(self, path):
+        """Moves the local backup path to the trash of the destination, which is
+        emptied by emptyTrash(). If it cannot be moved it is removed now."""
+        trash = os.path.join(self.options['Destination'], TRASH_FOLDER)
+        try:
+            os.makedirs(trash, 0o700, exist_ok=True)
+            # an interrupted run may have left a backup of the same name
+            holder = tempfile.mkdtemp(prefix='%s.' % os.path.basename(path), dir=trash)
+            os.rename(path, os.path.join(holder, os.path.basename(path)))
+        except OSError as error:
+            self.logger.logmsg('DEBUG', _('Could not move `%(a)s\' to the trash: %(b)s') % {'a': path, 'b': error})
+            shutil_modded.rmtree(path, onerror=self.onError)
+
+    def emptyTrash(self):
+        """Starts deleting the trash of the local destination in the background,
+        including whatever an interrupted run left there"""
+        trash = os.path.join(self.options['Destination'], TRASH_FOLDER)
+        if not os.path.isdir(trash):
+            return
+
+        def onError(func, path, exc_info):
+            # other sets backing up to the same destination share the trash
+            if issubclass(exc_info[0], FileNotFoundError) or (func is os.rmdir and path == trash):
+                return
+            self.onError(func, path, exc_info)
+        self.logger.logmsg('DEBUG', _('Deleting the old backups in `%s\'') % trash)
+        self.trashThread = threading.Thread(target=shutil_modded.rmtree, args=(trash,),
+                                            kwargs={'onerror': onError, 'workers': TRASH_WORKERS})
+        self.trashThread.start()
+
+    def waitForTrash(self):
+        """Waits until the trash started by emptyTrash() is deleted"""
+        if self.trashThread is None:
+            return
+        if self.trashThread.is_alive():
+            self.logger.logmsg('DEBUG', _('Waiting for the old backups to be deleted'))
+        self.trashThread.join()
+        self.trashThread = None
 
     def removeOldBackups(self):
-        """Get list of old backups and remove them"""
+        """Get list of old backups and remove them. Local backups are moved to
+        the trash, which is deleted while the new backup is made."""
         # get listing, local or remote
         if self.options['DestinationType'] == 'remote (ssh)':
-            client, sftpClient = sftp.connect(self.options['RemoteHost'], self.options['RemoteUsername'], self.options['RemotePassword'], self.options['RemotePort'])
-            listing = sftpClient.listdir(self.options['RemoteFolder'])
+            client, sftpClient = sftp.acquire(self.options['RemoteHost'], self.options['RemoteUsername'], self.options['RemotePassword'], self.options['RemotePort'],
+                                              tuning=sftp.transportTuning(self.options))
+            listing = sftp.metadataCache(sftpClient).listdir(sftpClient, self.options['RemoteFolder'])
         else:
             listing = os.listdir(self.options['Destination'])
         oldbackups = []
@@ -645,32 +799,54 @@ class SetBackupOperation(BackupOperation):
                 oldbackups.append(path)
         # ...And remove them.
         oldbackups.reverse()
+        expired = oldbackups[self.options['OldToKeep']:]
+        if self.snapshot is not None:
+            self.snapshot.begin(os.path.basename(self.dest), oldbackups, self.options['FullBackupEvery'])
+            if self.snapshot.isFull():
+                self.logger.logmsg('DEBUG', _('Creating a full archive'))
+            else:
+                self.logger.logmsg('DEBUG', _('Creating an incremental archive (level %i)') % self.snapshot.level)
+            # incremental archives are useless without the archives before them
+            required = self.snapshot.required([os.path.basename(self.dest)] + oldbackups[:self.options['OldToKeep']])
+            expired = [i for i in expired if i not in required]
         if self.options['DestinationType'] == 'remote (ssh)':
-            for path in oldbackups[self.options['OldToKeep']:]:
-                remoteBackup = os.path.join(self.options['RemoteFolder'], path)
-                self.logger.logmsg('DEBUG', _('Removing old backup `%(a)s\' on %(b)s') % {'a': remoteBackup, 'b': self.options['RemoteHost']})
-                sftp.remove(sftpClient, remoteBackup)
-            sftpClient.close()
-            client.close()
+            try:
+                if self.manifest is not None:
+                    expired = self.reuseRemoteBackup(client, sftpClient, oldbackups, expired)
+                for path in expired:
+                    remoteBackup = os.path.join(self.options['RemoteFolder'], path)
+                    self.logger.logmsg('DEBUG', _('Removing old backup `%(a)s\' on %(b)s') % {'a': remoteBackup, 'b': self.options['RemoteHost']})
+                    sftp.removeAll(sftpClient, remoteBackup, client=client, concurrency=self.options['TransferConcurrency'])
+            finally:
+                sftp.release(client, sftpClient)
         else:
-            if self.options['Engine'] == 'rsync' and self.options['Incremental'] and oldbackups:
+            if self.options['Engine'] == 'rsync' and self.options['Incremental'] and oldbackups \
+                    and self.options['OldToKeep'] > 0:
+                # Keep point-in-time snapshots: the new backup hard-links the
+                # files which did not change to the newest one
+                for path in expired:
+                    self.logger.logmsg('DEBUG', _('Removing old backup `%s\'') % path)
+                    self.trashBackup(os.path.join(self.options['Destination'], path))
+                newest = os.path.join(self.options['Destination'], oldbackups[0])
+                if os.path.isdir(newest) and newest != self.dest:
+                    self.logger.logmsg('DEBUG', _('Hard-linking unchanged files to `%s\'') % newest)
+                    self.linkDest = os.path.abspath(newest)
+            elif self.options['Engine'] == 'rsync' and self.options['Incremental'] and oldbackups:
                 for path in oldbackups[:-1]:
                     self.logger.logmsg('DEBUG', _('Removing old backup `%s\'') % path)
-                    path = os.path.join(self.options['Destination'], path)
-                    shutil_modded.rmtree(path, onerror=self.onError)
+                    self.trashBackup(os.path.join(self.options['Destination'], path))
                 oldIncrementalBackup = os.path.join(self.options['Destination'], oldbackups[-1])
-                if not oldIncrementalBackup.endswith('.tar') and not oldIncrementalBackup.endswith('.tar.gz') and \
-                        not oldIncrementalBackup.endswith('.tar.bz2'):  # oldIncrementalBackup = rsync
+                if not oldIncrementalBackup.endswith(('.tar', '.tar.gz', '.tar.bz2', '.tar.zst')):  # oldIncrementalBackup = rsync
                     self.logger.logmsg('DEBUG', _('Moving  `%s\' to `%s\'') % (oldIncrementalBackup, self.dest))
                     shutil_modded.move(oldIncrementalBackup, self.dest)
                 else:  # source = is not a rsync backup - remove it and start fresh
                     self.logger.logmsg('DEBUG', _('`%s\' is not an rsync backup - removing.') % oldIncrementalBackup)
-                    shutil_modded.rmtree(oldIncrementalBackup, onerror=self.onError)
+                    self.trashBackup(oldIncrementalBackup)
             else:
-                for path in oldbackups[self.options['OldToKeep']:]:
+                for path in expired:
                     self.logger.logmsg('DEBUG', _('Removing old backup `%s\'') % path)
-                    path = os.path.join(self.options['Destination'], path)
-                    shutil_modded.rmtree(path, onerror=self.onError)
+                    self.trashBackup(os.path.join(self.options['Destination'], path))
+            self.emptyTrash()
 
     def start(self):
         """Start the backup process. Should be called after executing user command."""
@@ -686,74 +862,88 @@ class SetBackupOperation(BackupOperation):
             self.execute_user_command(1, tokenized_command)
 
         try:
-            # Get the list of paths...
-            paths = self.parsePaths(self.config)
-            if not paths:
-                self.logger.logmsg('WARNING', _('There are no paths to backup!'))
-                return False
-
-            self.ifCancel()
-
-            if self.options['DestinationType'] == 'remote (ssh)':  # check if server settings are OK
-                if not self.checkRemoteServer():
-                    return False
-
-            self._status = BackupStatus.CLEANING_OLD
-            if not (self.options['Engine'] == 'rsync' and self.options['Incremental']) and \
-                    not self.options['DestinationType'] == 'remote (ssh)':
-                if not self.prepareDestinationFolder(self.options['Destination']):
+            try:
+                # Get the list of paths...
+                paths = self.parsePaths(self.config)
+                if not paths:
+                    self.logger.logmsg('WARNING', _('There are no paths to backup!'))
                     return False
-                if not (self.options['Engine'] == 'rsync' and self.options['Incremental']) \
-                        and os.path.exists(self.dest):
-                    self.logger.logmsg('WARNING', _('`%s\' exists and will be overwritten.') % self.dest)
-                    shutil_modded.rmtree(self.dest, onerror=self.onError)
-            self.ifCancel()
 
-            # Remove old stuff
-            self.removeOldBackups()
-            self.ifCancel()
-
-            self._status = BackupStatus.INITIALIZING
-            if self.options['PkgListsToFile']:
-                pkgListfiles = self.createPkgLists()
-            else:
-                pkgListfiles = []
-            if self.options['DiskInfoToFile']:
-                pkgListfiles.append(self.createDiskInfo())
-            self.ifCancel()
-            command = self.parseCommand()
-            self.addListFilesToBackup(pkgListfiles, command, self.options['Engine'], paths)
-            # Now that the paths & commands are set up...
-            retval = self.backupPaths(paths, command)
-            self.deleteListFiles(pkgListfiles)
-
-            if self.options['DestinationType'] == 'local':
-                try:
-                    octal_permissions = 0o700 if os.path.isdir(self.dest) else 0o600
-                    os.chmod(self.dest, octal_permissions)
-                except BaseException:
-                    pass  # might be ntfs
-
-        # Exception handlers in FuncAsThread() must return retval same values
-        except SystemExit:
-            # cancelled; the only time we skip the after command
-            return -2
-        except BaseException:
-            retval = False
-            import traceback
-            (etype, value, tb) = sys.exc_info()
-            self.traceback = ''.join(traceback.format_exception(etype, value, tb))
-            self.logger.logmsg('WARNING', _('There was an error while performing the backup!'))
-            self.logger.logmsg('ERROR', self.traceback)
-            # just incase we have leftover stuff running
-            self.cancelOperation()
-
-        if self.options["CommandAfter"]:
-            self._status = BackupStatus.EXECING_USER_COMMAND
-            # Find tokens and substitute them
-            tokenized_command = self.tokens_replace(self.options["CommandAfter"], self.date, retval)
-            self.execute_user_command(2, tokenized_command)
-
-        # All done!
-        self.logger.logmsg('INFO', _("Finished automatic backup operation of set '%s'") % self.config.getSetName())
-        return retval
+                self.ifCancel()
+
+                if self.options['DestinationType'] == 'remote (ssh)':  # check if server settings are OK
+                    if not self.checkRemoteServer():
+                        return False
+
+                if self.options['Engine'].startswith('tar') and self.options['Incremental']:
+                    self.snapshot = tar.Snapshot(os.path.join(constants.SETLOC, '%s.snapshot' % self.config.getSetName()))
+                elif self.options['Engine'] == 'rsync' and self.options['Incremental'] and \
+                        self.options['DestinationType'] == 'remote (ssh)':
+                    self.manifest = rsync.Manifest(os.path.join(constants.SETLOC, '%s.manifest' % self.config.getSetName()))
+
+                self._status = BackupStatus.CLEANING_OLD
+                if not (self.options['Engine'] == 'rsync' and self.options['Incremental']) and \
+                        not self.options['DestinationType'] == 'remote (ssh)':
+                    if not self.prepareDestinationFolder(self.options['Destination']):
+                        return False
+                    if not (self.options['Engine'] == 'rsync' and self.options['Incremental']) \
+                            and os.path.exists(self.dest):
+                        self.logger.logmsg('WARNING', _('`%s\' exists and will be overwritten.') % self.dest)
+                        shutil_modded.rmtree(self.dest, onerror=self.onError)
+                self.ifCancel()
+
+                # Remove old stuff
+                self.removeOldBackups()
+                self.ifCancel()
+
+                self._status = BackupStatus.INITIALIZING
+                if self.options['PkgListsToFile']:
+                    pkgListfiles = self.createPkgLists()
+                else:
+                    pkgListfiles = []
+                if self.options['DiskInfoToFile']:
+                    pkgListfiles.append(self.createDiskInfo())
+                self.ifCancel()
+                command = self.parseCommand()
+                self.addListFilesToBackup(pkgListfiles, command, self.options['Engine'], paths)
+                # Now that the paths & commands are set up...
+                retval = self.backupPaths(paths, command)
+                self.deleteListFiles(pkgListfiles)
+                if retval and self.snapshot is not None:
+                    self.snapshot.save()
+
+                if self.options['DestinationType'] == 'local':
+                    try:
+                        octal_permissions = 0o700 if os.path.isdir(self.dest) else 0o600
+                        os.chmod(self.dest, octal_permissions)
+                    except BaseException:
+                        pass  # might be ntfs
+
+            # Exception handlers in FuncAsThread() must return retval same values
+            except SystemExit:
+                # cancelled; the only time we skip the after command
+                return -2
+            except BaseException:
+                retval = False
+                import traceback
+                (etype, value, tb) = sys.exc_info()
+                self.traceback = ''.join(traceback.format_exception(etype, value, tb))
+                self.logger.logmsg('WARNING', _('There was an error while performing the backup!'))
+                self.logger.logmsg('ERROR', self.traceback)
+                # just incase we have leftover stuff running
+                self.cancelOperation()
+
+            self.waitForTrash()
+            if self.options["CommandAfter"]:
+                self._status = BackupStatus.EXECING_USER_COMMAND
+                # Find tokens and substitute them
+                tokenized_command = self.tokens_replace(self.options["CommandAfter"], self.date, retval)
+                self.execute_user_command(2, tokenized_command)
+
+            # All done!
+            self.logger.logmsg('INFO', _("Finished automatic backup operation of set '%s'") % self.config.getSetName())
+            return retval
+        finally:
+            # a cancelled or failed backup must not leave the trash being
+            # deleted after it finished
+            self.waitForTrash()
@@ -18,8 +18,8 @@
 This file contains the logic for the restore operation
 """
 import base64
+import json
 import os
-import tarfile
 import time
 
 from enum import Enum
@@ -30,6 +30,8 @@ from fwbackups import config
 from fwbackups import operations
 from fwbackups import shutil_modded
 from fwbackups import sftp
+from fwbackups.engines import compression
+from fwbackups.engines import tar
 
 
 class RestoreStatus(Enum):
@@ -59,15 +61,115 @@ class RestoreOperation(operations.Common):
         else:
             options['RemotePort'] = int(options['RemotePort'])
         options['RemotePassword'] = base64.b64decode(options['RemotePassword'])
+        # Options added after 1.43.8 may be missing from older configurations
+        options['TransferConcurrency'] = max(1, int(options.get('TransferConcurrency', 8)))
         return options
 
-    def tarfile_generator(self, members):
-        """Generator function for the tar extraction"""
+    def transportTuning(self):
+        """Returns the SSH transport tuning for receiving the remote source.
+        Compressed archives are not compressed again in transit."""
+        extension = os.path.splitext(self.options['RemoteSource'])[1]
+        engine = 'tar%s' % extension if extension in ['.gz', '.bz2', '.zst'] else None
+        return sftp.transportTuning(self.options, engine)
+
+    def tarfile_generator(self, members, deleted=None):
+        """Generator function for the tar extraction. The files listed as deleted
+        by an incremental archive are added to deleted."""
         for tarinfo in members:
             self.ifCancel(members)
+            if tarinfo.name == tar.INCREMENTAL_HEADER:
+                continue
+            elif tarinfo.name == tar.INCREMENTAL_DELETED:
+                if deleted is not None:
+                    deleted.extend(members.extractfile(tarinfo).read().decode('utf-8').splitlines())
+                continue
             self._currentName = os.path.basename(tarinfo.name)
             yield tarinfo
 
+    def openSource(self, path, sftpClient=None):
+        """Opens the archive at path for reading. If sftpClient is given, path
+        is on the server and is streamed from there."""
+        if sftpClient is None:
+            return open(path, 'rb')
+        return sftp.openStream(sftpClient, path)
+
+    def readIncrementalHeader(self, path, sftpClient=None):
+        """Returns the description of the incremental archive at path, or None
+        if it is not an incremental archive"""
+        fh = self.openSource(path, sftpClient)
+        try:
+            archive = compression.openArchive(fh, stream=sftpClient is not None)
+            try:
+                tarinfo = archive.next()
+                if tarinfo is None or tarinfo.name != tar.INCREMENTAL_HEADER:
+                    return None
+                return json.loads(archive.extractfile(tarinfo).read().decode('utf-8'))
+            finally:
+                archive.close()
+        finally:
+            fh.close()
+
+    def archiveChain(self, path, sftpClient=None):
+        """Returns the archives to extract to restore the archive at path, oldest
+        first. An incremental archive needs every archive back to the last full
+        one, which are looked for next to it; on the server if sftpClient is
+        given."""
+        chain = [path]
+        header = self.readIncrementalHeader(path, sftpClient)
+        while header is not None and header['previous']:
+            previous = os.path.join(os.path.dirname(path), header['previous'])
+            if sftpClient is None:
+                found = os.path.isfile(previous)
+            else:
+                found = sftp.exists(sftpClient, previous) and not sftp.isFolder(sftpClient, previous)
+            if not found:
+                raise operations.OperationError(_('The archive `%(a)s\' required to restore `%(b)s\' is missing') % {'a': header['previous'], 'b': os.path.basename(path)})
+            chain.insert(0, previous)
+            header = self.readIncrementalHeader(previous, sftpClient)
+        return chain
+
+    def removeDeleted(self, destination, deleted):
+        """Removes the files an incremental archive lists as deleted from the
+        files restored to destination so far"""
+        prefix = os.path.join(os.path.abspath(destination), '')
+        for name in deleted:
+            path = os.path.normpath(os.path.join(prefix, name))
+            if not path.startswith(prefix):
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil_modded.rmtree(path, onerror=self.onError)
+            elif os.path.lexists(path):
+                os.remove(path)
+
+    def extractArchive(self, path, destination, sftpClient=None):
+        """Extracts the tar archive at path into destination, whichever engine
+        created it. Incremental archives are restored by replaying their chain.
+        If sftpClient is given, path is on the server and each archive is
+        extracted while it is received, without a local copy."""
+        chain = self.archiveChain(path, sftpClient)
+        if len(chain) > 1:
+            self.logger.logmsg('INFO', _('Restoring %i incremental archives') % len(chain))
+        for path in chain:
+            self.logger.logmsg('DEBUG', _('Extracting `%s\'') % path)
+            deleted = []
+            fh = self.openSource(path, sftpClient)
+            try:
+                archive = compression.openArchive(fh, stream=sftpClient is not None)
+                try:
+                    archive.extractall(destination, members=self.tarfile_generator(archive, deleted))
+                finally:
+                    archive.close()
+            finally:
+                fh.close()
+            self.removeDeleted(destination, deleted)
+
+    def extractRemoteArchive(self, remote, destination):
+        """Extracts the tar archive remote, on the server, into destination as it
+        is received. If the connection drops the extraction starts over."""
+        sftp.retry(self.options['RemoteHost'], self.options['RemoteUsername'], self.options['RemotePassword'], self.options['RemotePort'],
+                   lambda client, sftpClient: self.extractArchive(remote, destination, sftpClient), onRetry=self.onConnectionLost,
+                   tuning=self.transportTuning())
+
     def start(self):
         """Restores a backup"""
         wasErrors = False
@@ -76,7 +178,7 @@ class RestoreOperation(operations.Common):
             thread = fwbackups.runFuncAsThread(sftp.testConnection,
                                                self.options['RemoteHost'], self.options['RemoteUsername'],
                                                self.options['RemotePassword'], self.options['RemotePort'],
-                                               self.options['RemoteSource'])
+                                               self.options['RemoteSource'], self.transportTuning())
             while thread.retval is None:
                 time.sleep(0.1)
             # Check for errors, if any
@@ -120,13 +222,18 @@ class RestoreOperation(operations.Common):
             self.logger.logmsg('INFO', _('Receiving files from server'))
             self._status = RestoreStatus.RECEIVING_FROM_REMOTE  # receiving files
             try:
-                # download file to location where we expect source to be
-                client, sftpClient = sftp.connect(self.options['RemoteHost'], self.options['RemoteUsername'], self.options['RemotePassword'], self.options['RemotePort'])
-                sftp.receive(sftpClient, self.options['RemoteSource'], self.options['Destination'])
-                # This is used later to terminate the restore operation early
-                remoteSourceIsFolder = sftp.isFolder(sftpClient, self.options['RemoteSource'])
-                sftpClient.close()
-                client.close()
+                # Folders are downloaded to the destination; archives are
+                # extracted below as they are received
+                def receive(client, sftpClient):
+                    if not sftp.isFolder(sftpClient, self.options['RemoteSource']):
+                        return False
+                    sftp.receive(sftpClient, self.options['RemoteSource'], self.options['Destination'],
+                                 self.options['TransferConcurrency'])
+                    # This is used later to terminate the restore operation early
+                    return True
+                remoteSourceIsFolder = sftp.retry(self.options['RemoteHost'], self.options['RemoteUsername'], self.options['RemotePassword'],
+                                                  self.options['RemotePort'], receive, onRetry=self.onConnectionLost,
+                                                  tuning=self.transportTuning())
             except Exception as error:
                 self.logger.logmsg('ERROR', _('Could not receive file from server: %s' % error))
                 wasErrors = True
@@ -137,11 +244,12 @@ class RestoreOperation(operations.Common):
                 return not wasErrors
         self._status = RestoreStatus.RESTORING  # restoring
         try:
-            if self.options['SourceType'] == 'set':  # we don't know the type
+            if self.options['RemoteSource']:  # a remote archive
+                self.extractRemoteArchive(self.options['RemoteSource'], self.options['Destination'])
+
+            elif self.options['SourceType'] == 'set':  # we don't know the type
                 if os.path.isfile(self.options['Source']):
-                    fh = tarfile.open(self.options['Source'], 'r')
-                    fh.extractall(self.options['Destination'])
-                    fh.close()
+                    self.extractArchive(self.options['Source'], self.options['Destination'])
                 elif os.path.isdir(self.options['Source']):  # we are dealing with rsync
                     shutil_modded.copytree(self.options['Source'], self.options['Destination'])
                 else:  # oops, something is up
@@ -150,9 +258,7 @@ class RestoreOperation(operations.Common):
 
             elif self.options['SourceType'] == 'local archive' or self.options['SourceType'] == 'remote archive (SSH)':
                 if os.path.isfile(self.options['Source']):
-                    fh = tarfile.open(self.options['Source'], 'r')
-                    fh.extractall(self.options['Destination'])
-                    fh.close()
+                    self.extractArchive(self.options['Source'], self.options['Destination'])
                 else:  # oops, something is up
                     self.logger.logmsg('ERROR', _('Source `%s\' is not an archive!' % self.options['Source']))
                     return False
@@ -164,10 +270,6 @@ class RestoreOperation(operations.Common):
                     return False
                 shutil_modded.copytree(self.options['Source'], self.options['Destination'])
 
-            # Clean up transfered files from remote server
-            if self.options['SourceType'] == 'remote archive (SSH)' or (self.options['SourceType'] == 'set' and self.options['RemoteSource']):
-                os.remove(self.options['Source'])
-
         except BaseException:
             self.logger.logmsg('ERROR', 'Error(s) occurred while restoring certain files or folders.\nPlease check the traceback below to determine if any files are incomplete or missing.')
             import sys
@@ -17,32 +17,497 @@
 """
 Functions for operations on remote computers
 """
-import glob
+import atexit
+import bisect
+import collections
+import functools
+import hashlib
+import json
 import os
 import paramiko
+import random
 import stat
+import threading
+import time
+import weakref
 
+from concurrent.futures import ThreadPoolExecutor
+import fwbackups
+from fwbackups import shutil_modded
 from fwbackups.i18n import _
 
+# Seconds an unused pooled connection is kept open
+POOL_IDLE_TIMEOUT = 300
+# Requests queued per concurrent session before the walk waits for them
+TRANSFER_QUEUE_DEPTH = 64
+# Files at least this large are uploaded in stripes over several channels
+STRIPE_THRESHOLD = 256 * 1024 * 1024
+# Each stripe writes the file in ranges of this many bytes at a time
+STRIPE_CHUNKSIZE = 32 * 1024 * 1024
+# Blocks of an upload read back to verify it when the server cannot hash it
+VERIFY_SAMPLES = 16
+VERIFY_BLOCKSIZE = 64 * 1024
+# Read requests in flight for each downloaded file, which bounds the memory a
+# download needs (paramiko reads 32 KiB per request)
+PREFETCH_REQUESTS = 64
+# Files at least this large are transferred through a resumable .part file
+RESUME_THRESHOLD = 16 * 1024 * 1024
+# Resumable transfers are read, written and verified in chunks this large
+RESUME_CHUNKSIZE = 8 * 1024 * 1024
+# and confirmed and checkpointed every this many bytes, a multiple of it
+CHECKPOINT_INTERVAL = 64 * 1024 * 1024
+PART_SUFFIX = '.part'
+CHECKPOINT_SUFFIX = '.part.checkpoint'
+# Attempts after a dropped connection, and the longest wait between them
+TRANSFER_RETRIES = 5
+RETRY_MAX_DELAY = 60
+# Engines whose output is already compressed
+COMPRESSED_ENGINES = ['tar.gz', 'tar.bz2', 'tar.zst']
+# Data sent to the server by each profile of benchmarkTransport()
+BENCHMARK_SIZE = 64 * 1024 * 1024
 
-def connect(host, username, password, port=22, timeout=120):
-    """Opens a SSH connection and returns the SFTP client object"""
+# How SSH connections are set up: whether to compress, the ciphers to prefer
+# (in order, before paramiko's own), the window and maximum packet sizes of
+# the channels (0 for paramiko's defaults) and the number of bytes after which
+# keys are renegotiated (0 for paramiko's default)
+Tuning = collections.namedtuple('Tuning', ['compress', 'ciphers', 'window', 'packet', 'rekey'])
+DEFAULT_TUNING = Tuning(True, (), 0, 0, 0)
+# Profiles compared by benchmarkTransport()
+BENCHMARK_PROFILES = [('default', DEFAULT_TUNING),
+                      ('uncompressed', Tuning(False, (), 0, 0, 0)),
+                      ('aes128-gcm', Tuning(False, ('aes128-gcm@openssh.com',), 0, 0, 0)),
+                      ('aes256-gcm', Tuning(False, ('aes256-gcm@openssh.com',), 0, 0, 0)),
+                      ('aes128-ctr', Tuning(False, ('aes128-ctr',), 0, 0, 0)),
+                      ('large-window', Tuning(False, ('aes128-gcm@openssh.com',), 16 * 1024 * 1024, 256 * 1024, 0))]
+
+
+def transportTuning(options, engine=None):
+    """Returns the Tuning for the Transport* options of a set. With automatic
+    compression, data from engine (by default the set's Engine) which is
+    already compressed isn't compressed again."""
+    if engine is None:
+        engine = options.get('Engine')
+    compression = options.get('TransportCompression', 'auto')
+    if compression == 'auto':
+        compress = engine not in COMPRESSED_ENGINES
+    else:
+        compress = compression in ['on', 1, '1', True, 'True']
+    ciphers = tuple(options.get('TransportCiphers', '').replace(',', ' ').split())
+    return Tuning(compress, ciphers, int(options.get('TransportWindowSize', 0)),
+                  int(options.get('TransportPacketSize', 0)), int(options.get('TransportRekeyBytes', 0)))
+
+
+def _transportFactory(tuning):
+    """Returns a function creating paramiko Transports set up for tuning"""
+    def factory(sock, **kwargs):
+        if tuning.window:
+            kwargs['default_window_size'] = tuning.window
+        if tuning.packet:
+            kwargs['default_max_packet_size'] = tuning.packet
+        transport = paramiko.Transport(sock, **kwargs)
+        if tuning.ciphers:
+            options = transport.get_security_options()
+            known = [i for i in tuning.ciphers if i in options.ciphers]
+            options.ciphers = known + [i for i in options.ciphers if i not in known]
+        if tuning.rekey:
+            transport.packetizer.REKEY_BYTES = tuning.rekey
+        return transport
+    return factory
+
+
+def connect(host, username, password, port=22, timeout=120, tuning=DEFAULT_TUNING):
+    """Opens a SSH connection set up according to tuning and returns the SFTP
+    client object"""
     port = int(port)
     client = paramiko.SSHClient()
     client.load_system_host_keys()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(host, port, username, password, timeout=timeout)
-    try:
-        transport = client.get_transport()
-        transport.use_compression(True)
-    except BaseException:  # < v1.7.2 - no compression support
-        pass
+    client.connect(host, port, username, password, timeout=timeout, compress=tuning.compress,
+                   transport_factory=_transportFactory(tuning))
     sftp = client.open_sftp()
     return client, sftp
 
 
+def benchmarkTransport(host, username, password, port, folder, profiles=BENCHMARK_PROFILES, size=BENCHMARK_SIZE):
+    """Uploads size bytes of random data to a temporary file in the remote
+    folder once with each (name, Tuning) of profiles, on a new connection each
+    time. Returns a list of (name, bytes per second or None, error or None)."""
+    data = os.urandom(shutil_modded.COPY_BUFSIZE)
+    results = []
+    for name, tuning in profiles:
+        client = None
+        try:
+            client, sftp = connect(host, username, password, port, tuning=tuning)
+            path = os.path.join(folder, '.fwbackups-benchmark-%i' % os.getpid())
+            start = time.monotonic()
+            try:
+                with sftp.open(path, 'wb') as fh:
+                    fh.set_pipelined(True)
+                    for i in range(0, size, len(data)):
+                        fh.write(data)
+                    # wait until the server wrote everything
+                    fh.stat()
+                elapsed = time.monotonic() - start
+            finally:
+                try:
+                    sftp.remove(path)
+                except IOError:
+                    pass
+            results.append((name, size / max(elapsed, 1e-6), None))
+        except (EOFError, OSError, paramiko.SSHException) as error:
+            results.append((name, None, str(error)))
+        finally:
+            if client is not None:
+                client.close()
+    return results
+
+
+def _passwordDigest(password):
+    """Returns a digest of password, to tell connections apart by it without
+    keeping it in the clear"""
+    if password is None:
+        return None
+    if isinstance(password, str):
+        password = password.encode('utf-8')
+    return hashlib.sha256(password).hexdigest()
+
+
+class ConnectionPool:
+    """Keeps authenticated SSH connections open so that every phase of a
+    backup, and every set backed up by the same process, can share them.
+
+    Connections are keyed on the host, port, username, password and tuning.
+    Each user of a connection gets its own SFTP session, so a connection can
+    be used by several threads at once. Connections which have been unused for longer
+    than idleTimeout are closed by a background timer, and dead ones are
+    replaced."""
+
+    def __init__(self, idleTimeout=POOL_IDLE_TIMEOUT):
+        self.idleTimeout = idleTimeout
+        self.lock = threading.Lock()
+        # key -> [client, users, time last released]
+        self.connections = {}
+        # key -> Event set once the thread connecting for key is done
+        self.connecting = {}
+        self.timer = None
+
+    def isHealthy(self, client):
+        """Checks that the connection of client still works"""
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (EOFError, OSError, paramiko.SSHException):
+            return False
+        return True
+
+    def expire(self):
+        """Closes the connections which have been unused for too long. Returns
+        the seconds until the next unused one times out, or None. The lock must
+        be held."""
+        now = time.monotonic()
+        remaining = None
+        for key, (client, users, released) in list(self.connections.items()):
+            if users:
+                continue
+            if now - released > self.idleTimeout:
+                client.close()
+                del self.connections[key]
+            elif remaining is None or released + self.idleTimeout - now < remaining:
+                remaining = released + self.idleTimeout - now
+        return remaining
+
+    def scheduleExpiry(self, delay):
+        """Runs expireIdle() after delay seconds unless it is already scheduled.
+        The lock must be held."""
+        if self.timer is None:
+            self.timer = threading.Timer(delay, self.expireIdle)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def expireIdle(self):
+        """Closes the timed out connections, and waits for the next one to time
+        out if others are still unused"""
+        with self.lock:
+            self.timer = None
+            remaining = self.expire()
+            if remaining is not None:
+                # a little late, so that it has timed out by then
+                self.scheduleExpiry(remaining + 1)
+
+    def acquire(self, host, username, password, port=22, timeout=120, tuning=DEFAULT_TUNING):
+        """Returns a connected client and a new SFTP session for it. Both must be
+        given back with release()."""
+        # a connection only serves those who know the password it was opened with
+        key = (host, int(port), username, _passwordDigest(password), tuning)
+        while True:
+            with self.lock:
+                self.expire()
+                entry = self.connections.get(key)
+                if entry is not None and not self.isHealthy(entry[0]):
+                    if not entry[1]:
+                        entry[0].close()
+                    del self.connections[key]
+                    entry = None
+                if entry is not None:
+                    entry[1] += 1
+                    break
+                connecting = self.connecting.get(key)
+                if connecting is None:
+                    # connect without the lock, which would keep every other
+                    # thread waiting for as long as the server takes
+                    connecting = self.connecting[key] = threading.Event()
+                    break
+            # another thread is connecting to the same server; share its
+            # connection, or try again if it failed
+            connecting.wait()
+        if entry is None:
+            client = None
+            try:
+                client, sftp = connect(host, username, password, port, timeout, tuning)
+            finally:
+                with self.lock:
+                    del self.connecting[key]
+                    if client is not None:
+                        self.connections[key] = [client, 1, 0]
+                connecting.set()
+            return client, sftp
+        try:
+            return entry[0], entry[0].open_sftp()
+        except BaseException:
+            self.release(entry[0])
+            raise
+
+    def release(self, client, sftp=None):
+        """Closes sftp and gives the connection of client back to the pool"""
+        if sftp is not None:
+            sftp.close()
+        with self.lock:
+            for key, entry in list(self.connections.items()):
+                if entry[0] is client:
+                    entry[1] -= 1
+                    entry[2] = time.monotonic()
+                    break
+            else:
+                # no longer pooled (replaced after it died)
+                client.close()
+            if self.expire() is not None:
+                self.scheduleExpiry(self.idleTimeout + 1)
+
+    def closeAll(self):
+        """Closes every connection in the pool"""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            for client, users, released in self.connections.values():
+                client.close()
+            self.connections.clear()
+
+
+pool = ConnectionPool()
+atexit.register(pool.closeAll)
+
+
+def acquire(host, username, password, port=22, timeout=120, tuning=DEFAULT_TUNING):
+    """Returns a client and SFTP session from the shared connection pool"""
+    return pool.acquire(host, username, password, port, timeout, tuning)
+
+
+def release(client, sftp=None):
+    """Gives a client obtained from acquire() back to the shared pool"""
+    pool.release(client, sftp)
+
+
+def execute(client, command):
+    """Runs command on the remote host. Returns the exit status, output and
+    errors of the command."""
+    stdin, stdout, stderr = client.exec_command(command)
+    stdin.close()
+    output = stdout.read().decode('utf-8', errors='replace')
+    errors = stderr.read().decode('utf-8', errors='replace')
+    return stdout.channel.recv_exit_status(), output, errors
+
+
+def retry(host, username, password, port, func, retries=TRANSFER_RETRIES, onRetry=None, tuning=DEFAULT_TUNING):
+    """Calls func(client, sftp) with a pooled connection and returns its
+    result. If the connection drops, func is called again on a new connection
+    after waiting 1, 2, 4... seconds, up to retries times; resumable transfers
+    then carry on where the failed attempt stopped. onRetry(error, delay) is
+    called before each wait. Errors which leave the connection working are
+    raised straight away, as are those of the first connection; reconnecting
+    is retried in the same way."""
+    delay = 1
+    for attempt in range(retries + 1):
+        try:
+            client, session = acquire(host, username, password, port, tuning=tuning)
+        except (paramiko.AuthenticationException, paramiko.BadHostKeyException):
+            raise
+        except (EOFError, OSError, paramiko.SSHException) as error:
+            # the server or the network may still be down
+            if attempt == 0 or attempt == retries:
+                raise
+            if onRetry is not None:
+                onRetry(error, delay)
+        else:
+            try:
+                return func(client, session)
+            except (EOFError, OSError, paramiko.SSHException) as error:
+                transport = client.get_transport()
+                if attempt == retries or (transport is not None and transport.is_active()):
+                    raise
+                if onRetry is not None:
+                    onRetry(error, delay)
+            finally:
+                release(client, session)
+        time.sleep(delay)
+        delay = min(delay * 2, RETRY_MAX_DELAY)
+
+
+def _parent(path):
+    """Returns the folder holding the normalized remote path; relative paths
+    are in the current folder of the session, '.'"""
+    return os.path.dirname(path) or '.'
+
+
+class MetadataCache:
+    """The types of the remote paths an SFTP session has seen, so that most
+    checks don't need a round trip to the server.
+
+    Folders are listed in bulk with listdir_attr the first time one of their
+    entries is looked up; a path missing from a listed folder doesn't exist.
+    Our own changes through mkdir(), removeFile(), rmtree() and the uploads
+    keep the cache current. The cache lives as long as the session, so
+    changes made by others while it is open may be missed."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # path -> the S_IFMT bits of its lstat() mode, or None if missing
+        self.modes = {}
+        # folder -> its entries in self.modes
+        self.children = {}
+        # folders whose every entry is in self.modes
+        self.listed = set()
+        # path -> the attributes of a regular file as it was listed
+        self.attributes = {}
+
+    def _set(self, path, mode):
+        """Records mode for path. The lock must be held."""
+        if self.modes.get(path) == stat.S_IFDIR and mode != stat.S_IFDIR:
+            self._dropBelow(path)
+        self.modes[path] = mode
+        self.attributes.pop(path, None)
+        parent = _parent(path)
+        if parent != path:
+            self.children.setdefault(parent, set()).add(path)
+
+    def _dropBelow(self, path):
+        """Forgets everything below path. The lock must be held."""
+        for child in self.children.pop(path, ()):
+            self.attributes.pop(child, None)
+            if self.modes.pop(child, None) == stat.S_IFDIR:
+                self._dropBelow(child)
+        self.listed.discard(path)
+
+    def listdir(self, sftp, folder):
+        """Returns the names in the remote folder, caching their types"""
+        folder = os.path.normpath(folder)
+        entries = sftp.listdir_attr(folder)
+        with self.lock:
+            found = set([os.path.normpath(os.path.join(folder, entry.filename)) for entry in entries])
+            for child in list(self.children.get(folder, ())):
+                if child not in found:
+                    self._set(child, None)
+            for entry in entries:
+                path = os.path.normpath(os.path.join(folder, entry.filename))
+                self._set(path, stat.S_IFMT(entry.st_mode))
+                if stat.S_ISREG(entry.st_mode):
+                    self.attributes[path] = entry
+            self._set(folder, stat.S_IFDIR)
+            self.listed.add(folder)
+        return [entry.filename for entry in entries]
+
+    def mode(self, sftp, path):
+        """Returns the file type bits of the lstat() mode of path, or None if it
+        doesn't exist"""
+        path = os.path.normpath(path)
+        parent = _parent(path)
+        # '/', '.' and '..' are not entries of a listing
+        listed = os.path.basename(path) not in ('', '.', '..')
+        with self.lock:
+            if path in self.modes:
+                return self.modes[path]
+            if listed and (parent in self.listed or (parent in self.modes and self.modes[parent] != stat.S_IFDIR)):
+                return None
+        if listed:
+            try:
+                self.listdir(sftp, parent)
+            except IOError:
+                pass  # the parent may not be readable; ask for path itself
+            else:
+                with self.lock:
+                    return self.modes.get(path)
+        try:
+            mode = stat.S_IFMT(sftp.lstat(path).st_mode)
+        except IOError:
+            mode = None
+        with self.lock:
+            self._set(path, mode)
+        return mode
+
+    def stat(self, sftp, path):
+        """Returns the attributes of the remote file path, as listed if it is a
+        regular file whose folder was listed"""
+        with self.lock:
+            attributes = self.attributes.get(os.path.normpath(path))
+        if attributes is None:
+            attributes = sftp.stat(path)
+        return attributes
+
+    def found(self, path, mode):
+        """Records that we gave path the file type mode, or removed it if mode is
+        None. A folder we created is known to be empty."""
+        path = os.path.normpath(path)
+        with self.lock:
+            created = mode == stat.S_IFDIR and self.modes.get(path) != stat.S_IFDIR
+            self._set(path, mode)
+            if created:
+                self.listed.add(path)
+
+    def forget(self, path):
+        """Stops trusting what is known about path and below"""
+        path = os.path.normpath(path)
+        parent = _parent(path)
+        with self.lock:
+            self.attributes.pop(path, None)
+            if self.modes.pop(path, None) == stat.S_IFDIR:
+                self._dropBelow(path)
+            self.children.get(parent, set()).discard(path)
+            self.listed.discard(parent)
+
+
+_caches = weakref.WeakKeyDictionary()
+_cachesLock = threading.Lock()
+
+
+def metadataCache(sftp):
+    """Returns the MetadataCache of the SFTP session sftp"""
+    with _cachesLock:
+        cache = _caches.get(sftp)
+        if cache is None:
+            cache = _caches[sftp] = MetadataCache()
+        return cache
+
+
 def exists(sftp, path):
     """Determines if path on remote host exists"""
+    mode = metadataCache(sftp).mode(sftp, path)
+    if mode is None:
+        return False
+    if mode != stat.S_IFLNK:
+        return True
+    # a link exists if what it points to does
     try:
         sftp.stat(path)
         return True
@@ -52,13 +517,13 @@ def exists(sftp, path):
 
 def isFolder(sftp, path):
     """Determines if path on remote host is a folder"""
-    if not exists(sftp, path):
-        return False
-    try:
-        mode = sftp.lstat(path).st_mode
-    except os.error:
-        mode = 0  # so below returns False
-    return stat.S_ISDIR(mode)
+    return metadataCache(sftp).mode(sftp, path) == stat.S_IFDIR
+
+
+def mkdir(sftp, folder):
+    """Creates folder on the remote server"""
+    sftp.mkdir(folder)
+    metadataCache(sftp).found(folder, stat.S_IFDIR)
 
 
 def mkdir_p(sftp, folder):
@@ -67,10 +532,16 @@ def mkdir_p(sftp, folder):
     if not exists(sftp, path):
         mkdir_p(sftp, path)
     if not exists(sftp, folder):
-        sftp.mkdir(folder)
+        mkdir(sftp, folder)
     return True
 
 
+def removeFile(sftp, path):
+    """Removes the file or link path from the server"""
+    sftp.remove(path)
+    metadataCache(sftp).found(path, None)
+
+
 def remove(sftp, path):
     """Removes file or folder path from the server"""
     if not exists(sftp, path):
@@ -78,163 +549,716 @@ def remove(sftp, path):
     if isFolder(sftp, path):
         return rmtree(sftp, path)
     else:
-        return sftp.remove(path)
+        return removeFile(sftp, path)
 
 
 def rmtree(sftp, folder):
     """Remove folder on remote host recursively"""
-    for name in sftp.listdir(folder):
+    for name in metadataCache(sftp).listdir(sftp, folder):
         fullpath = os.path.join(folder, name)
         if isFolder(sftp, fullpath):
             rmtree(sftp, fullpath)
         else:
-            sftp.remove(fullpath)
+            removeFile(sftp, fullpath)
     sftp.rmdir(folder)
+    metadataCache(sftp).found(folder, None)
 
 
-def receive(sftp, src, dst):
-    """Calls recieveFile or recieveFolder depending on 'src' (remote)."""
+def removeAll(sftp, path, client=None, concurrency=1):
+    """Removes the file or folder path from the server as quickly as possible,
+    for pruning large backups. If client is given, the server is first asked to
+    run rm -rf itself; if it doesn't allow that, the tree is listed with
+    listdir_attr and its files are removed concurrency at a time, then its
+    folders deepest first. Raises IOError if anything could not be removed."""
+    try:
+        mode = sftp.lstat(path).st_mode
+    except IOError:
+        return False
+    if not stat.S_ISDIR(mode):
+        removeFile(sftp, path)
+        return True
+    if client is not None:
+        try:
+            retval, output, errors = execute(client, "rm -rf -- '%s'" % fwbackups.escapeQuotes(path, 1))
+        except paramiko.SSHException:
+            retval = None  # the server may only allow SFTP
+        if retval == 0:
+            # ask the server; the cache still lists what rm removed
+            try:
+                sftp.lstat(path)
+            except IOError:
+                metadataCache(sftp).found(path, None)
+                return True
+    remover = TransferPool(sftp, concurrency)
+    # folder depth -> folders
+    folders = collections.defaultdict(list)
+    try:
+        pending = [path]
+        while pending:
+            folder = pending.pop()
+            folders[folder.count('/')].append(folder)
+            try:
+                entries = sftp.listdir_attr(folder)
+            except IOError as reason:
+                remover.errors.append('%s: %s' % (folder, reason))
+                continue
+            for entry in entries:
+                fullpath = os.path.join(folder, entry.filename)
+                if stat.S_ISDIR(entry.st_mode):
+                    pending.append(fullpath)
+                else:
+                    remover.submit(fullpath, lambda session, fullpath: session.remove(fullpath), fullpath)
+        remover.wait()
+        # the folders at the same depth are independent
+        for depth in sorted(folders, reverse=True):
+            for folder in folders[depth]:
+                remover.submit(folder, lambda session, folder: session.rmdir(folder), folder)
+            remover.wait()
+    finally:
+        errors = remover.close()
+        # what we listed was not cached; drop anything cached before
+        metadataCache(sftp).forget(path)
+    if errors:
+        raise IOError(_('Could not remove %(a)i files or folders, including %(b)s') % {'a': len(errors), 'b': errors[0]})
+    return True
+
+
+def receive(sftp, src, dst, concurrency=1):
+    """Calls recieveFile or recieveFolder depending on 'src' (remote). Folders
+    are received concurrency files at a time."""
     if not exists(sftp, src):
         return False
     if isFolder(sftp, src):
-        return receiveFolder(sftp, src, dst)
+        return receiveFolder(sftp, src, dst, concurrency)
     else:
         return receiveFile(sftp, src, dst)
 
 
+def openStream(sftp, src):
+    """Opens the remote file src to be read from start to end, requesting the
+    data ahead of the reader with a bounded amount of it held in memory"""
+    fh = sftp.open(src, 'rb', shutil_modded.COPY_BUFSIZE)
+    try:
+        fh.prefetch(metadataCache(sftp).stat(sftp, src).st_size, max_concurrent_requests=PREFETCH_REQUESTS)
+    except BaseException:
+        fh.close()
+        raise
+    return fh
+
+
 def receiveFile(sftp, src, dst):
     """Gets src (remote) to dst (local). dst may be a specific filename or a
        folder."""
     if os.path.isdir(dst):
         # Use same filename
         dst = os.path.join(dst, os.path.basename(src))
-    sftp.get(src, dst)
+    _receiveFile(sftp, src, dst, metadataCache(sftp).stat(sftp, src))
     return True
 
 
-def receiveFolder(sftp, src, dst):
+def _receiveFile(sftp, src, dst, st):
+    """Gets the remote file src, whose attributes are st, to the local file dst"""
+    if st.st_size >= RESUME_THRESHOLD:
+        receiveResumable(sftp, src, dst, st)
+    else:
+        # prefetch, but keep a bounded amount of the file in memory
+        sftp.get(src, dst, max_concurrent_prefetch_requests=PREFETCH_REQUESTS)
+
+
+def receiveFolder(sftp, src, dst, concurrency=1):
     """Gets src (remote) to dst (local). Ignores file permissions and symbolic
-       links."""
+       links. Files are downloaded concurrency at a time; if some of them
+       cannot be, IOError is raised once all the others were received."""
+    downloader = TransferPool(sftp, concurrency)
+    try:
+        _receiveFolder(sftp, src, dst, downloader)
+    finally:
+        errors = downloader.close()
+    if errors:
+        raise IOError(_('Could not receive %(a)i files, including %(b)s') % {'a': len(errors), 'b': errors[0]})
+    return True
+
+
+def _receiveFolder(sftp, src, dst, downloader):
+    """Walks src for receiveFolder(), handing its files to downloader"""
     if not os.path.exists(dst):
         os.mkdir(dst)
-    for path in sftp.listdir(src):
-        receive(sftp, os.path.join(src, path), os.path.join(dst, path))
-    return True
+    cache = metadataCache(sftp)
+    for name in cache.listdir(sftp, src):
+        path, local = os.path.join(src, name), os.path.join(dst, name)
+        if isFolder(sftp, path):
+            _receiveFolder(sftp, path, local, downloader)
+        elif exists(sftp, path):
+            downloader.submit('%s --> %s' % (path, local), _receiveFile, path, local, cache.stat(sftp, path))
+
+
+class TransferPool:
+    """Runs uploads, downloads or other requests on several SFTP sessions of the same
+    connection at once, so that trees of small files are not limited by the
+    round trips each file needs. Errors from individual files are collected in
+    self.errors.
+
+    With a concurrency of 1 each request runs immediately on sftp."""
+
+    def __init__(self, sftp, concurrency=1):
+        self.sftp = sftp
+        self.concurrency = max(1, concurrency)
+        self.errors = []
+        self.pending = collections.deque()
+        self.sessions = []
+        self.local = threading.local()
+        self.executor = None
+        if self.concurrency > 1:
+            self.transport = sftp.get_channel().get_transport()
+            self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+    def session(self):
+        """Returns the SFTP session of the calling worker thread"""
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = paramiko.SFTPClient.from_transport(self.transport)
+            self.local.session = session
+            self.sessions.append(session)
+        return session
 
+    def run(self, description, func, args, done):
+        try:
+            func(self.sftp if self.executor is None else self.session(), *args)
+        except (IOError, os.error) as reason:
+            # don't halt the entire copy, just report the errors at the end
+            self.errors.append('%s: %s' % (description, reason))
+            return
+        if done is not None:
+            done()
+
+    def submit(self, description, func, *args, done=None):
+        """Calls func(session, *args). done is called once it succeeded; if it
+        fails, the error is recorded as belonging to description."""
+        if self.executor is None:
+            return self.run(description, func, args, done)
+        while len(self.pending) >= self.concurrency * TRANSFER_QUEUE_DEPTH:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(self.run, description, func, args, done))
+
+    def found(self, dst, mode, done):
+        """Returns a function recording in the metadata cache that dst was given
+        the file type mode, then calling done. It is only called once the
+        request succeeded, so a failed one leaves the cache as it was."""
+        cache = metadataCache(self.sftp)
+
+        def found():
+            cache.found(dst, mode)
+            if done is not None:
+                done()
+        return found
+
+    def put(self, src, dst, done=None):
+        """Uploads the local file src to the file dst with uploadFile()"""
+        self.submit('%s --> %s' % (src, dst), uploadFile, src, dst, done=self.found(dst, stat.S_IFREG, done))
+
+    def symlink(self, linkto, dst, done=None):
+        """Creates the symbolic link dst pointing to linkto"""
+        self.submit('%s --> %s' % (linkto, dst), lambda session: session.symlink(linkto, dst),
+                    done=self.found(dst, stat.S_IFLNK, done))
 
-def put(sftp, src, dst, symlinks=False, excludes=[]):
-    """Transfers the local file or folder src to folder dst on the remote host."""
+    def wait(self):
+        """Waits for the requests submitted so far to finish"""
+        while self.pending:
+            self.pending.popleft().result()
+
+    def close(self):
+        """Waits for all requests to finish. Returns the errors."""
+        if self.executor is not None:
+            try:
+                self.wait()
+            finally:
+                for future in self.pending:
+                    future.cancel()
+                self.executor.shutdown(wait=True)
+                for session in self.sessions:
+                    session.close()
+        return self.errors
+
+
+def put(sftp, src, dst, symlinks=False, excludes=[], concurrency=1):
+    """Transfers the local file or folder src to folder dst on the remote host.
+    Folders are uploaded concurrency files at a time. excludes is a list of
+    patterns or a fwbackups.ExcludeMatcher."""
+    excludes = fwbackups.excludeMatcher(excludes)
     mkdir_p(sftp, dst)
     if not isFolder(sftp, dst):
         return False
     if os.path.isdir(src):
-        putFolder(sftp, src, dst, symlinks, excludes)
+        putFolder(sftp, src, dst, symlinks, excludes, concurrency)
     elif os.path.isfile(src):
         putFile(sftp, src, dst, symlinks, excludes)
     else:
         return False
     return True
 
-# The following glob-related functions are a slightly modified version of the
-# Python module glob.py included in Python 2.5.2 to work with any directory.
-# Original file is Copyright (c) 2001 - 2006 Python Software Foundation.
-
-
-def iglob(pattern, folder):
-    if not glob.has_magic(pattern):  # nothing to expand
-        pattern2 = os.path.normpath(folder + os.sep + pattern)  # make relative to folder
-        if os.path.lexists(pattern):
-            yield pattern
-        elif os.path.lexists(pattern2):
-            yield pattern2
-        return
-    dirname, basename = os.path.split(pattern)
-    if not dirname:
-        for name in glob.glob1(folder, basename):
-            yield os.path.normpath(folder + os.sep + name)
-        return
-    if glob.has_magic(dirname):
-        dirs = iglob(dirname)
-    else:
-        dirs = [dirname]
-    if glob.has_magic(basename):
-        glob_in_dir = glob.glob1
-    else:
-        glob_in_dir = glob.glob0
-    for dirname in dirs:
-        for name in glob_in_dir(dirname, basename):
-            yield os.path.join(dirname, name)
-
-
-def myglob(pattern, folder):
-    # generator --> list
-    return list(iglob(pattern, folder))
-
 
 def putFile(sftp, src, dst, symlinks=False, excludes=[]):
     """Moves src (local) to dst (remote). Assumes dst exists and is a folder"""
-    for exclude in excludes:
-        if src in myglob(exclude, os.path.dirname(src)):
-            return True
+    if fwbackups.excludeMatcher(excludes).matches(src):
+        return True
     # open sftp, upload then close
     if symlinks and os.path.islink(src):
         linkto = os.readlink(src)
-        return sftp.symlink(linkto, dst)
+        sftp.symlink(linkto, dst)
+        return metadataCache(sftp).found(dst, stat.S_IFLNK)
+    return uploadFile(sftp, src, os.path.join(dst, os.path.basename(src)))
+
+
+def uploadFile(sftp, src, dst, sent=None):
+    """Uploads the local file src as the remote file dst. Files of at least
+    RESUME_THRESHOLD bytes go through putResumable(). If sent, an
+    UploadDigest, is given it is fed the data as it is sent."""
+    if os.path.getsize(src) >= RESUME_THRESHOLD:
+        return putResumable(sftp, src, dst, sent)
+    if sent is None:
+        attributes = sftp.put(src, dst)
     else:
-        return sftp.put(src, os.path.join(dst, os.path.basename(src)))
+        with open(src, 'rb') as local, sftp.open(dst, 'wb') as remote:
+            remote.set_pipelined(True)
+            shutil_modded.copyfileobj(local, DigestWriter(remote, sent))
+        attributes = True
+    metadataCache(sftp).found(dst, stat.S_IFREG)
+    return attributes
+
+
+class UploadDigest:
+    """Follows the data of an upload as it is sent: its size, its SHA-256 and
+    the SHA-256 of a random sample of its blocks, so that the remote copy can
+    be verified without downloading it again"""
+
+    def __init__(self, samples=VERIFY_SAMPLES, blocksize=VERIFY_BLOCKSIZE):
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.maxSamples = samples
+        self.blocksize = blocksize
+        # [offset, length, SHA-256] of the sampled blocks
+        self.samples = []
+        self.block = None
+        self.slot = None
+        self.random = random.Random()
+
+    def _startBlock(self, index):
+        """Decides whether the block index is sampled. The choice is made
+        before the block is seen (reservoir sampling), so that only sampled
+        blocks are hashed twice."""
+        if index < self.maxSamples:
+            self.slot = index
+        else:
+            slot = self.random.randrange(index + 1)
+            self.slot = slot if slot < self.maxSamples else None
+        self.block = hashlib.sha256() if self.slot is not None else None
+
+    def _endBlock(self):
+        if self.block is None:
+            return
+        offset = (self.size - 1) // self.blocksize * self.blocksize
+        sample = [offset, self.size - offset, self.block.hexdigest()]
+        if self.slot == len(self.samples):
+            self.samples.append(sample)
+        else:
+            self.samples[self.slot] = sample
+        self.block = None
+
+    def update(self, data):
+        """Adds the next data of the upload"""
+        self.sha256.update(data)
+        view = memoryview(data)
+        while view:
+            offset = self.size % self.blocksize
+            if offset == 0:
+                self._startBlock(self.size // self.blocksize)
+            length = min(len(view), self.blocksize - offset)
+            if self.block is not None:
+                self.block.update(view[:length])
+            self.size += length
+            view = view[length:]
+            if self.size % self.blocksize == 0:
+                self._endBlock()
+
+    def finish(self):
+        """Ends the upload; the last block may be incomplete"""
+        self._endBlock()
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+class DigestWriter:
+    """A write-only file object passing data on to fileobj and to the
+    UploadDigest digest"""
+
+    def __init__(self, fileobj, digest):
+        self.fileobj = fileobj
+        self.digest = digest
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.fileobj.write(data)
+
+
+def digestFile(path):
+    """Returns the UploadDigest of the local file path"""
+    digest = UploadDigest()
+    with open(path, 'rb') as fh:
+        while True:
+            buf = fh.read(shutil_modded.COPY_BUFSIZE)
+            if not buf:
+                break
+            digest.update(buf)
+    digest.finish()
+    return digest
+
+
+def remoteHash(client, sftp, path):
+    """Has the server compute the SHA-256 digest of the remote file path.
+    Returns how it was computed and the digest in hexadecimal, or (None, None)
+    if the server has no way of computing it."""
+    try:
+        # check-file extension; most servers don't support it
+        with sftp.open(path, 'rb') as fh:
+            return 'check-file', fh.check('sha256').hex()
+    except IOError:
+        pass
+    if client is None:
+        return None, None
+    try:
+        retval, output, errors = execute(client, "sha256sum '%s'" % fwbackups.escapeQuotes(path, 1))
+    except paramiko.SSHException:
+        return None, None
+    if retval != 0 or not output:
+        return None, None
+    return 'sha256sum', output.split()[0].lower()
+
+
+def verifyUpload(client, sftp, path, digest):
+    """Checks that the remote file path holds the data described by the
+    UploadDigest digest: its size, then its SHA-256 if the server can compute
+    it, or else the sampled blocks read back from the server. Returns how it
+    was checked; raises IOError if it differs."""
+    digest.finish()
+    size = sftp.stat(path).st_size
+    if size != digest.size:
+        raise IOError(_('%(a)s is %(b)i bytes long instead of %(c)i once uploaded') % {'a': path, 'b': size, 'c': digest.size})
+    method, remoteDigest = remoteHash(client, sftp, path)
+    if remoteDigest is not None:
+        if remoteDigest != digest.hexdigest():
+            raise IOError(_('%(a)s has the checksum %(b)s instead of %(c)s once uploaded') % {'a': path, 'b': remoteDigest, 'c': digest.hexdigest()})
+        return method
+    with sftp.open(path, 'rb') as fh:
+        for offset, length, expected in sorted(digest.samples):
+            fh.seek(offset)
+            if hashlib.sha256(fh.read(length)).hexdigest() != expected:
+                raise IOError(_('%(a)s differs from the uploaded data at offset %(b)i') % {'a': path, 'b': offset})
+    return 'sampled'
+
+
+def _putStripe(session, src, dst, size, offsets, chunksize):
+    """Writes the ranges of src starting at offsets to dst, until none are left"""
+    with open(src, 'rb') as local:
+        with session.open(dst, 'r+b') as remote:
+            remote.set_pipelined(True)
+            while True:
+                try:
+                    offset = offsets.popleft()
+                except IndexError:
+                    return
+                local.seek(offset)
+                remote.seek(offset)
+                remaining = min(chunksize, size - offset)
+                while remaining:
+                    buf = local.read(min(shutil_modded.COPY_BUFSIZE, remaining))
+                    if not buf:
+                        raise IOError(_('%s changed while it was uploaded') % src)
+                    remote.write(buf)
+                    remaining -= len(buf)
+
+
+def _loadCheckpoint(opener, path, size, mtime):
+    """Returns the (offset, digest) the checkpoint path records: the first
+    offset bytes were transferred and confirmed, and digest is that of the
+    chunk ending at offset. Returns (0, None) if it is missing or belongs to
+    another version of the file"""
+    try:
+        with opener(path, 'rb') as fh:
+            data = json.loads(fh.read())
+        if data['size'] == size and data['mtime'] == mtime and data['chunksize'] == RESUME_CHUNKSIZE:
+            return int(data['offset']), data['digest']
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+    return 0, None
+
+
+def _saveCheckpoint(opener, path, size, mtime, offset, digest):
+    """Records that the first offset bytes were transferred and confirmed"""
+    data = {'size': size, 'mtime': mtime, 'chunksize': RESUME_CHUNKSIZE,
+            'offset': offset, 'digest': digest}
+    with opener(path, 'wb') as fh:
+        fh.write(json.dumps(data).encode('utf-8'))
+
+
+def _verifyCheckpoint(part, offset, digest):
+    """Returns offset if the chunk of the .part file part ending there still
+    matches digest, or 0 if the transfer must start over"""
+    if offset <= 0 or offset % RESUME_CHUNKSIZE or digest is None:
+        return 0
+    part.seek(offset - RESUME_CHUNKSIZE)
+    if hashlib.sha256(part.read(RESUME_CHUNKSIZE)).hexdigest() != digest:
+        return 0
+    return offset
+
+
+@functools.lru_cache(maxsize=4)
+def _zeroDigest(length):
+    """Returns the digest of a chunk of length zeros"""
+    return hashlib.sha256(bytes(length)).hexdigest()
+
+
+def _holdsData(ranges, start, end):
+    """Returns whether any of the sorted (start, end) data ranges overlaps the
+    bytes from start to end"""
+    i = bisect.bisect_left(ranges, (end,))
+    return i > 0 and ranges[i - 1][1] > start
+
+
+def _copyChunks(source, part, size, offset, confirm, save, ranges=None, sent=None):
+    """Copies source to part from offset onwards. Every CHECKPOINT_INTERVAL
+    bytes confirm() is called to wait for what was written so far and
+    save(offset, digest) to record it; in between, writes are not waited for.
+    If ranges, the (start, end) ranges of a sparse source which hold data, is
+    given, the chunks in its holes are not read and the blocks of zeros are
+    left as holes in part; otherwise part is written densely. If sent, an
+    UploadDigest, is given it is fed all of source, the part an earlier attempt
+    copied being read again for it."""
+    if sent is not None:
+        source.seek(0)
+        remaining = offset
+        while remaining:
+            data = source.read(min(shutil_modded.COPY_BUFSIZE, remaining))
+            if not data:
+                raise IOError(_('The file changed while it was transferred'))
+            sent.update(data)
+            remaining -= len(data)
+    source.seek(offset)
+    # holes are not written, so nothing an earlier attempt left may remain
+    part.truncate(offset)
+    part.seek(offset)
+    while offset < size:
+        length = min(RESUME_CHUNKSIZE, size - offset)
+        end = offset + length
+        checkpoint = end < size and end % CHECKPOINT_INTERVAL == 0
+        if ranges is not None and not _holdsData(ranges, offset, end):
+            source.seek(end)
+            part.seek(end)
+            digest = _zeroDigest(length)
+            if sent is not None:
+                sent.update(bytes(length))
+        else:
+            data = source.read(length)
+            if len(data) != length:
+                raise IOError(_('The file changed while it was transferred'))
+            if ranges is None:
+                part.write(data)
+            else:
+                shutil_modded.writeSparse(part, data)
+            digest = checkpoint and hashlib.sha256(data).hexdigest()
+            if sent is not None:
+                sent.update(data)
+        offset = end
+        if checkpoint:
+            # skipped holes only move the position; give part its length so
+            # the checkpointed chunk can be read back
+            part.truncate(offset)
+            confirm()
+            save(offset, digest)
+    part.truncate(size)
 
 
-def putFolder(sftp, src, dst, symlinks=False, excludes=[]):
+def putResumable(sftp, src, dst, sent=None):
+    """Uploads the local file src to the remote file dst. The data is written to
+    dst.part, and every CHECKPOINT_INTERVAL bytes dst.part.checkpoint records
+    how much of it the server confirmed; if an earlier upload was interrupted,
+    this one continues from there once the last chunk before it is verified.
+    dst.part is renamed to dst once complete. The holes of a sparse src are
+    neither read nor sent. If sent, an UploadDigest, is given it is fed the
+    data of src as it is sent."""
+    st = os.stat(src)
+    part, checkpoint = dst + PART_SUFFIX, dst + CHECKPOINT_SUFFIX
+    offset, digest = _loadCheckpoint(sftp.open, checkpoint, st.st_size, st.st_mtime)
+    try:
+        remote = sftp.open(part, 'r+b')
+    except IOError:
+        remote = sftp.open(part, 'wb')
+        offset = 0
+    with open(src, 'rb') as local, remote:
+        offset = _verifyCheckpoint(remote, offset, digest)
+        ranges = None
+        if shutil_modded.isSparse(st):
+            ranges = shutil_modded.dataRanges(local.fileno(), st.st_size)
+        remote.set_pipelined(True)
+
+        def confirm():
+            # the server answers in order, so once it answered this every
+            # write before it was done
+            remote.flush()
+            remote.stat()
+        _copyChunks(local, remote, st.st_size, offset, confirm,
+                    lambda offset, digest: _saveCheckpoint(sftp.open, checkpoint, st.st_size, st.st_mtime, offset, digest),
+                    ranges, sent)
+    try:
+        sftp.posix_rename(part, dst)
+    except IOError:
+        # no posix-rename extension; rename won't replace an existing file
+        remove(sftp, dst)
+        sftp.rename(part, dst)
+    metadataCache(sftp).found(dst, stat.S_IFREG)
+    try:
+        sftp.remove(checkpoint)
+    except IOError:
+        # transfers shorter than CHECKPOINT_INTERVAL are never checkpointed
+        pass
+    return True
+
+
+def receiveResumable(sftp, src, dst, st=None):
+    """Gets the remote file src to the local file dst, through dst.part and
+    dst.part.checkpoint in the same way as putResumable()."""
+    if st is None:
+        st = sftp.stat(src)
+    part, checkpoint = dst + PART_SUFFIX, dst + CHECKPOINT_SUFFIX
+    offset, digest = _loadCheckpoint(open, checkpoint, st.st_size, st.st_mtime)
+    try:
+        local = open(part, 'r+b')
+    except IOError:
+        local = open(part, 'wb+')
+        offset = 0
+    with sftp.open(src, 'rb') as remote, local:
+        offset = _verifyCheckpoint(local, offset, digest)
+        remote.seek(offset)
+        remote.prefetch(st.st_size, max_concurrent_requests=PREFETCH_REQUESTS)
+
+        def confirm():
+            local.flush()
+            os.fsync(local.fileno())
+        _copyChunks(remote, local, st.st_size, offset, confirm,
+                    lambda offset, digest: _saveCheckpoint(open, checkpoint, st.st_size, st.st_mtime, offset, digest))
+    os.replace(part, dst)
+    try:
+        os.remove(checkpoint)
+    except OSError:
+        # transfers shorter than CHECKPOINT_INTERVAL are never checkpointed
+        pass
+    return True
+
+
+def putStriped(sftp, src, dst, stripes=4, client=None, connect=None, chunksize=STRIPE_CHUNKSIZE):
+    """Uploads the local file src to the remote file dst in stripes parallel
+    streams, each writing its own byte ranges of dst. A single SSH channel is
+    limited by its window and by one CPU for the cipher, so when connect() is
+    given each stripe uses a new connection from it; otherwise the stripes are
+    channels of the connection of sftp.
+
+    dst is checked afterwards with verifyUpload(); client is used to have the
+    server compute its checksum if given. Raises IOError if it differs from
+    src, after removing dst. Returns the UploadDigest of src and how dst was
+    checked."""
+    size = os.path.getsize(src)
+    with sftp.open(dst, 'wb') as fh:
+        fh.truncate(size)
+    metadataCache(sftp).found(dst, stat.S_IFREG)
+    offsets = collections.deque(range(0, size, chunksize))
+    stripes = max(1, min(stripes, len(offsets)))
+
+    def stripe():
+        if connect is not None:
+            stripeClient, session = connect()
+        else:
+            stripeClient, session = None, paramiko.SFTPClient.from_transport(sftp.get_channel().get_transport())
+        try:
+            _putStripe(session, src, dst, size, offsets, chunksize)
+        except BaseException:
+            # let the other stripes stop too
+            offsets.clear()
+            raise
+        finally:
+            session.close()
+            if stripeClient is not None:
+                stripeClient.close()
+
+    executor = ThreadPoolExecutor(max_workers=stripes + 1)
+    try:
+        digest = executor.submit(digestFile, src)
+        futures = [executor.submit(stripe) for i in range(stripes)]
+        for future in futures:
+            future.result()
+        digest = digest.result()
+        method = verifyUpload(client, sftp, dst, digest)
+    except BaseException:
+        offsets.clear()
+        executor.shutdown(wait=True)
+        try:
+            removeFile(sftp, dst)
+        except IOError:
+            pass
+        raise
+    executor.shutdown(wait=True)
+    return digest, method
+
+
+def putFolder(sftp, src, dst, symlinks=False, excludes=[], concurrency=1):
     """Copies src (local) to dst/[src] (remote). Folder dst must exist"""
-    # Check if the src itself is an exclude
-    # FIXME: This means we check any subdirectory against excludes 2x
-    SKIPME = 0
-    for exclude in excludes:  # excludes pattern matching
-        if src in myglob(exclude, os.path.dirname(src)):
-            SKIPME = 1
-            break  # it is pointless to process further excludes
-    if SKIPME:
+    excludes = fwbackups.excludeMatcher(excludes)
+    if excludes.matches(src):
         return
+    uploader = TransferPool(sftp, concurrency)
     errors = []
+    try:
+        _putFolder(sftp, src, dst, symlinks, excludes, uploader, errors)
+    finally:
+        errors.extend(uploader.close())
+    if errors:
+        print(_('Could not copy some files due to errors:'))
+        print('\n'.join(errors))
+
+
+def _putFolder(sftp, src, dst, symlinks, excludes, uploader, errors):
+    """Walks src for putFolder(), handing its files to uploader. src itself
+    must not be excluded."""
     dst = os.path.join(dst, os.path.basename(src))
     if not exists(sftp, dst):
-        sftp.mkdir(dst)
+        mkdir(sftp, dst)
     # sftp.chdir(dst)
     for item in os.listdir(src):
         # make absolute paths
         src_abs = os.path.join(src, item)
         dst_abs = os.path.join(dst, item)
-        SKIPME = 0
-        for exclude in excludes:  # excludes pattern matching
-            if src_abs in myglob(exclude, os.path.dirname(src_abs)):
-                SKIPME = 1
-                break  # it is pointless to process further excludes
-        if SKIPME:
+        if excludes.matches(src_abs):
             continue
         try:
             # at this point, excludes have been handled and we're ready to copy.
             if symlinks and os.path.islink(src_abs):
-                linkto = os.readlink(src_abs)
-                sftp.symlink(linkto, dst_abs)
+                uploader.symlink(os.readlink(src_abs), dst_abs)
             elif os.path.isdir(src_abs):
                 # run this again in the subfolder, uploading to the parent folder
-                putFolder(sftp, src_abs, os.path.dirname(dst_abs), symlinks, excludes)
+                _putFolder(sftp, src_abs, os.path.dirname(dst_abs), symlinks, excludes, uploader, errors)
             elif os.path.isfile(src_abs):
-                sftp.put(src_abs, dst_abs)
+                uploader.put(src_abs, dst_abs)
             else:
                 print(_('`%s\' is not a file, folder or link! Skipping.') % src_abs)
         except (IOError, os.error) as reason:
             # don't halt the entire copy, just print the errors at the end
             errors.append('%s --> %s: %s' % (src_abs, dst_abs, reason))
-    if errors:
-        print(_('Could not copy some files due to errors:'))
-        print('\n'.join(errors))
 
 
-def testConnection(host, username, password, port, path):
-    """Tests connecting to a SSH/SFTP connection with the supplied arguments.
-    Returns True if connection was successful."""
-    client, sftp = connect(host, username, password, port, timeout=10)
+def testConnection(host, username, password, port, path, tuning=DEFAULT_TUNING):
+    """Tests connecting to a SSH/SFTP connection with the supplied arguments and
+    the transport tuning. Returns True if connection was successful. A new
+    connection is always made, so that the credentials are really checked."""
+    client, sftp = connect(host, username, password, port, timeout=10, tuning=tuning)
     try:
         return isFolder(sftp, path)
     finally:
@@ -21,21 +21,52 @@ as sockets. Original file Copyright (c) 2001 - 2006 Python Software Foundation
 Utility functions for copying files and directory trees.
 *** The functions here don't copy the resource fork or other metadata on Mac.
 """
+import collections
+import errno
 import os
 import stat
 from os.path import abspath
 import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import fwbackups
 from fwbackups.i18n import _
 
+# fcntl is only available on Unix
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 __all__ = ["copyfileobj", "copyfile", "copymode", "copystat", "copy", "copy2",
            "copytree", "move", "rmtree", "Error"]
 
 
+# Size of the reads and writes when data is copied through Python, here and by
+# the engines and SFTP transfers
+COPY_BUFSIZE = 1024 * 1024
+# Most bytes handed to the kernel to copy in one call
+KERNEL_CHUNKSIZE = 64 * 1024 * 1024
+# Whether rmtree() can work relative to the file descriptors of folders
+_RMTREE_FD = ({os.open, os.rmdir, os.unlink} <= os.supports_dir_fd and
+              os.scandir in os.supports_fd and hasattr(os, 'O_DIRECTORY') and
+              hasattr(os, 'O_NOFOLLOW'))
+# Files copied at once by copytree()
+COPY_WORKERS = 8
+# Blocks of zeros this long are left as holes by writeSparse()
+SPARSE_BLOCKSIZE = 64 * 1024
+# ioctl(2) request making a file share the blocks of another (Linux)
+FICLONE = 0x40049409
+# Errors meaning a kernel copy is not possible between two files, so the next
+# method should be tried
+_UNSUPPORTED = (errno.EBADF, errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+                errno.ENOTSUP, errno.EOPNOTSUPP, errno.EXDEV)
+
+
 class Error(EnvironmentError):
     pass
 
 
-def copyfileobj(fsrc, fdst, length=16 * 1024):
+def copyfileobj(fsrc, fdst, length=COPY_BUFSIZE):
     """Copy data from file-like object fsrc to file-like object fdst"""
     while True:
         buf = fsrc.read(length)
@@ -57,17 +88,138 @@ def _samefile(src, dst):
             os.path.normcase(os.path.abspath(dst)))
 
 
+def isSparse(st):
+    """Returns whether the file whose stat is st has holes"""
+    return getattr(st, 'st_blocks', None) is not None and st.st_blocks * 512 < st.st_size
+
+
+def dataRanges(fd, size):
+    """Returns the (start, end) ranges of the first size bytes of the file open
+    as fd which hold data, skipping its holes. Moves the file position. Where
+    holes cannot be found the whole file is one range."""
+    if not hasattr(os, 'SEEK_DATA'):
+        return [(0, size)]
+    ranges = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as error:
+            if error.errno == errno.ENXIO:
+                break  # only a hole is left
+            if error.errno in _UNSUPPORTED:
+                return [(0, size)]
+            raise
+        if start >= size:
+            break
+        offset = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        ranges.append((start, offset))
+    return ranges
+
+
+def writeSparse(fdst, data):
+    """Writes data to the file object fdst at its position, seeking over the
+    blocks of zeros instead of writing them so that they are left as holes.
+    A hole at the end does not extend fdst; truncate it to its size after the
+    last write."""
+    position = fdst.tell()
+    # data[start:] is not written yet; fdst is at position + current
+    start = current = 0
+    for offset in range(0, len(data), SPARSE_BLOCKSIZE):
+        end = min(offset + SPARSE_BLOCKSIZE, len(data))
+        if data.count(0, offset, end) < end - offset:
+            continue
+        if start < offset:
+            if current != start:
+                fdst.seek(position + start)
+            fdst.write(data[start:offset])
+            current = offset
+        start = end
+    if start < len(data):
+        if current != start:
+            fdst.seek(position + start)
+        fdst.write(data[start:])
+    elif current != len(data):
+        fdst.seek(position + len(data))
+
+
+def _clone(infd, outfd, size):
+    """Makes the empty file outfd share the blocks of infd, size bytes long, on
+    copy-on-write filesystems, leaving both positioned at the end. Returns
+    whether it could."""
+    if fcntl is None or not size:
+        return False
+    try:
+        fcntl.ioctl(outfd, FICLONE, infd)
+    except OSError:
+        return False  # not the same filesystem, or it cannot share blocks
+    os.lseek(infd, os.lseek(outfd, 0, os.SEEK_END), os.SEEK_SET)
+    return True
+
+
+def _kernelCopy(infd, outfd, size):
+    """Copies up to size bytes from infd to outfd without passing them through
+    Python, with copy_file_range(2) or sendfile(2). Both files are left
+    positioned after the data copied; returns how much that was."""
+    methods = []
+    if hasattr(os, 'copy_file_range'):
+        methods.append(os.copy_file_range)
+    if hasattr(os, 'sendfile'):
+        methods.append(lambda infd, outfd, count: os.sendfile(outfd, infd, None, count))
+    copied = 0
+    for func in methods:
+        try:
+            while copied < size:
+                count = func(infd, outfd, min(size - copied, KERNEL_CHUNKSIZE))
+                if not count:
+                    return copied
+                copied += count
+            return copied
+        except OSError as error:
+            # carry on from where this method stopped with the next one
+            if error.errno not in _UNSUPPORTED:
+                raise
+    return copied
+
+
+def _copySparse(infd, outfd, size):
+    """Copies the data of infd, size bytes long, to the empty file outfd, which
+    gets holes where infd has them"""
+    for start, end in dataRanges(infd, size):
+        os.lseek(infd, start, os.SEEK_SET)
+        os.lseek(outfd, start, os.SEEK_SET)
+        copied = _kernelCopy(infd, outfd, end - start)
+        while copied < end - start:
+            buf = os.read(infd, min(COPY_BUFSIZE, end - start - copied))
+            if not buf:
+                break
+            view = memoryview(buf)
+            while view:
+                view = view[os.write(outfd, view):]
+            copied += len(buf)
+    os.ftruncate(outfd, size)
+
+
 def copyfile(src, dst):
-    """Copy data from src to dst"""
+    """Copy data from src to dst. The kernel copies the data when it can; any
+    left over, such as that of files whose size is unknown, is copied through
+    Python. Holes in src are left as holes in dst."""
     if _samefile(src, dst):
         raise Error("`%s` and `%s` are the same file" % (src, dst))
-    fsrc = None
-    fdst = None
-    fsrc = open(src, 'rb')
-    fdst = open(dst, 'wb')
-    copyfileobj(fsrc, fdst)
-    fdst.close()
-    fsrc.close()
+    _copydata(src, dst)
+
+
+def _copydata(src, dst, st=None):
+    """Copies the data of src, whose stat is st if known, to dst"""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        if st is None:
+            st = os.fstat(infd)
+        if not _clone(infd, outfd, st.st_size):
+            if isSparse(st):
+                return _copySparse(infd, outfd, st.st_size)
+            _kernelCopy(infd, outfd, st.st_size)
+        copyfileobj(fsrc, fdst)
 
 
 def copymode(src, dst):
@@ -78,9 +230,11 @@ def copymode(src, dst):
         os.chmod(dst, mode)
 
 
-def copystat(src, dst):
-    """Copy all stat info (mode bits, atime and mtime) from src to dst"""
-    st = os.stat(src)
+def copystat(src, dst, st=None):
+    """Copy all stat info (mode bits, atime and mtime) from src to dst. st is
+    the stat of src, if it is already known."""
+    if st is None:
+        st = os.stat(src)
     mode = stat.S_IMODE(st.st_mode)
     if hasattr(os, 'utime'):
         os.utime(dst, (st.st_atime, st.st_mtime))
@@ -104,51 +258,146 @@ def copy2(src, dst):
     copystat(src, dst)
 
 
-def copytree(src, dst, symlinks=False):
-    """Recursively copy a directory tree using copy2().
+def copytree(src, dst, symlinks=False, excludes=None, workers=COPY_WORKERS):
+    """Recursively copy a directory tree, copying the files like copy2().
 
-    The destination directory must not already exist.
-    If exception(s) occur, an Error is raised with a list of reasons.
+    If exception(s) occur, they are printed once the rest of the tree was
+    copied.
 
     If the optional symlinks flag is true, symbolic links in the
     source tree result in symbolic links in the destination tree; if
     it is false, the contents of the files pointed to by symbolic
-    links are copied."""
+    links are copied. Paths matching excludes, a list of patterns or a
+    fwbackups.ExcludeMatcher, are skipped.
+
+    The tree is walked once, creating the folders in order, while the files
+    are copied up to workers at a time. The folders get the times and mode
+    bits of the source last, once nothing more is written to them."""
+    excludes = fwbackups.excludeMatcher(excludes)
+    errors = []
+    folders = []
     if os.path.isdir(src):
-        names = os.listdir(src)
+        with os.scandir(src) as it:
+            entries = list(it)
+        # an existing destination keeps its own times and mode bits
+        created = not os.path.exists(dst)
     else:
-        names = [src]
-    if not os.path.exists(dst):
+        entries = [_PathEntry(src)]
+        created = False
+    copier = _TreeCopier(workers, errors)
+    try:
+        _copytree(entries, dst, symlinks, excludes, copier, folders, errors)
+    finally:
+        copier.close()
+    if created:
+        folders.append((src, dst, _PathEntry(src)))
+    # folders come after their subfolders, as the mode may make them read-only
+    for srcname, dstname, entry in folders:
+        try:
+            copystat(srcname, dstname, entry.stat())
+        except (IOError, os.error) as why:
+            errors.append('%s --> %s: %s' % (srcname, dstname, why))
+    if errors:
+        print(_('Couldn\'t copy some files due to errors:'))
+        print('\n'.join(errors))
+
+
+class _TreeCopier:
+    """Copies files like copy2() on a pool of worker threads for copytree(),
+    collecting the errors in errors. Files are copied straight away if workers
+    is 1."""
+
+    def __init__(self, workers, errors):
+        self.errors = errors
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        # enough queued copies to keep the workers busy, without holding an
+        # entry for every file of a large tree
+        self.depth = workers * 4
+        self.pending = collections.deque()
+
+    def copy(self, srcname, dstname, st):
+        try:
+            _copydata(srcname, dstname, st)
+            copystat(srcname, dstname, st)
+        except (IOError, os.error) as why:
+            self.errors.append('%s --> %s: %s' % (srcname, dstname, why))
+
+    def submit(self, srcname, dstname, st):
+        """Copies srcname, whose stat is st, to dstname or queues the copy"""
+        if self.executor is None:
+            return self.copy(srcname, dstname, st)
+        while len(self.pending) >= self.depth:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(self.copy, srcname, dstname, st))
+
+    def close(self):
+        """Waits for the queued copies. Unexpected errors, which copy() does not
+        collect, are raised here as they would be without workers."""
+        if self.executor is None:
+            return
+        try:
+            while self.pending:
+                self.pending.popleft().result()
+        finally:
+            for future in self.pending:
+                future.cancel()
+            self.pending.clear()
+            self.executor.shutdown(wait=True)
+
+
+class _PathEntry:
+    """Stands in for the os.DirEntry of a path that was not listed"""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_file(self):
+        return os.path.isfile(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+def _copytree(entries, dst, symlinks, excludes, copier, folders, errors):
+    """Walks entries, the os.DirEntry objects of a folder, for copytree(),
+    creating the folders of dst and handing the files to copier. The types
+    come from the listing, so each entry is stat'ed at most once. The
+    subfolders are added to folders after their own."""
+    try:
         os.mkdir(dst, 0o755)
-    errors = []
-    for name in names:
-        srcname = os.path.join(src, name)
-        # dstname = os.path.join(dst, name)
-        dstname = os.path.join(dst, os.path.split(name)[1])
+    except FileExistsError:
+        pass
+    for entry in entries:
+        srcname = entry.path
+        dstname = os.path.join(dst, entry.name)
+        if excludes.matches(srcname):
+            continue
         try:
-            if symlinks and os.path.islink(srcname):
+            if symlinks and entry.is_symlink():
                 linkto = os.readlink(srcname)
                 os.symlink(linkto, dstname)
-            elif os.path.isdir(srcname):
-                copytree(srcname, dstname, symlinks)
-            elif not os.path.isfile(srcname):
+            elif entry.is_dir():
+                with os.scandir(srcname) as it:
+                    children = list(it)
+                _copytree(children, dstname, symlinks, excludes, copier, folders, errors)
+                folders.append((srcname, dstname, entry))
+            elif not entry.is_file():
                 print(_('`%s\' isn\'t a file, folder or link! Skipping.') % srcname)
             else:
-                copy2(srcname, dstname)
+                copier.submit(srcname, dstname, entry.stat())
             # XXX What about devices, sockets etc.? Done.
         except (IOError, os.error) as why:
             errors.append('%s --> %s: %s' % (srcname, dstname, why))
-        # catch the Error from the recursive copytree so that we can
-        # continue with other files
-        except Error as err:
-            errors.extend(err.args[0])
-    if errors:
-        print(_('Couldn\'t copy some files due to errors:'))
-        print('\n'.join(errors))
-        pass
 
 
-def copytree_fullpaths(src, dst, symlinks=False):
+def copytree_fullpaths(src, dst, symlinks=False, excludes=None, workers=COPY_WORKERS):
     """
     Recursively copy a directory tree using copytree().
     Use full paths - eg src of /home/admin/[files] to
@@ -165,10 +414,10 @@ def copytree_fullpaths(src, dst, symlinks=False):
     dstPath = dst + srcPath
     if not os.path.exists(dstPath):
         os.makedirs(dstPath, 0o755)
-    copytree(src, dstPath, symlinks)
+    copytree(src, dstPath, symlinks, excludes, workers)
 
 
-def rmtree(path, ignore_errors=False, onerror=None):
+def rmtree(path, ignore_errors=False, onerror=None, workers=1):
     """Recursively delete a directory tree.
 
     If ignore_errors is set, errors are ignored; otherwise, if onerror
@@ -176,7 +425,10 @@ def rmtree(path, ignore_errors=False, onerror=None):
     path, exc_info) where func is os.listdir, os.remove, or os.rmdir;
     path is the argument to that function that caused it to fail; and
     exc_info is a tuple returned by sys.exc_info().  If ignore_errors
-    is false and onerror is None, an exception is raised."""
+    is false and onerror is None, an exception is raised.
+
+    If workers is more than 1, that many threads empty different folders of
+    the tree at once; onerror may then be called from any of them."""
     if ignore_errors:
         def onerror(*args):
             pass
@@ -191,28 +443,135 @@ def rmtree(path, ignore_errors=False, onerror=None):
             onerror(os.listdir, path, sys.exc_info())
             return
 
-    names = []
+    if workers > 1:
+        _rmtreeParallel(path, onerror, workers)
+    elif _RMTREE_FD:
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        except os.error:
+            onerror(os.listdir, path, sys.exc_info())
+        else:
+            try:
+                _rmtreeFd(fd, path, onerror)
+            finally:
+                os.close(fd)
+    else:
+        _rmtreePath(path, onerror)
     try:
-        names = os.listdir(path)
+        os.rmdir(path)
+    except os.error:
+        onerror(os.rmdir, path, sys.exc_info())
+
+
+def _rmtreeFd(fd, path, onerror):
+    """Deletes the contents of the folder path, open as fd, for rmtree(). The
+    entries are removed relative to fd, so that their paths are not looked up
+    again, and their types come from the listing."""
+    entries = []
+    try:
+        with os.scandir(fd) as it:
+            entries = list(it)
     except os.error:
         onerror(os.listdir, path, sys.exc_info())
-    for name in names:
-        fullname = os.path.join(path, name)
+    for entry in entries:
+        fullname = os.path.join(path, entry.name)
         try:
-            mode = os.lstat(fullname).st_mode
+            isdir = entry.is_dir(follow_symlinks=False)
         except os.error:
-            mode = 0
-        if stat.S_ISDIR(mode):
-            rmtree(fullname, ignore_errors, onerror)
-        else:
+            isdir = False
+        if not isdir:
             try:
-                os.remove(fullname)
+                os.unlink(entry.name, dir_fd=fd)
             except os.error:
                 onerror(os.remove, fullname, sys.exc_info())
+            continue
+        try:
+            # don't follow a link that replaced the folder since it was listed
+            subfd = os.open(entry.name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=fd)
+        except os.error:
+            onerror(os.listdir, fullname, sys.exc_info())
+        else:
+            try:
+                _rmtreeFd(subfd, fullname, onerror)
+            finally:
+                os.close(subfd)
+        try:
+            os.rmdir(entry.name, dir_fd=fd)
+        except os.error:
+            onerror(os.rmdir, fullname, sys.exc_info())
+
+
+def _rmtreePath(path, onerror):
+    """Deletes the contents of the folder path for rmtree() where folders cannot
+    be used as file descriptors"""
+    entries = []
     try:
-        os.rmdir(path)
+        with os.scandir(path) as it:
+            entries = list(it)
     except os.error:
-        onerror(os.rmdir, path, sys.exc_info())
+        onerror(os.listdir, path, sys.exc_info())
+    for entry in entries:
+        try:
+            isdir = entry.is_dir(follow_symlinks=False)
+        except os.error:
+            isdir = False
+        if isdir:
+            _rmtreePath(entry.path, onerror)
+            try:
+                os.rmdir(entry.path)
+            except os.error:
+                onerror(os.rmdir, entry.path, sys.exc_info())
+        else:
+            try:
+                os.remove(entry.path)
+            except os.error:
+                onerror(os.remove, entry.path, sys.exc_info())
+
+
+def _rmtreeParallel(path, onerror, workers):
+    """Deletes the contents of the folder path for rmtree(), emptying up to
+    workers folders at once. The folders themselves are removed once they are
+    all empty, the deepest first."""
+    folders = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_emptyFolder, path, onerror)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for folder in future.result():
+                    folders.append(folder)
+                    pending.add(executor.submit(_emptyFolder, folder, onerror))
+    # folders were found after the folder containing them
+    for folder in reversed(folders):
+        try:
+            os.rmdir(folder)
+        except os.error:
+            onerror(os.rmdir, folder, sys.exc_info())
+
+
+def _emptyFolder(path, onerror):
+    """Removes everything but the subfolders from the folder path, returning
+    the paths of those"""
+    entries = []
+    folders = []
+    try:
+        with os.scandir(path) as it:
+            entries = list(it)
+    except os.error:
+        onerror(os.listdir, path, sys.exc_info())
+    for entry in entries:
+        try:
+            isdir = entry.is_dir(follow_symlinks=False)
+        except os.error:
+            isdir = False
+        if isdir:
+            folders.append(entry.path)
+            continue
+        try:
+            os.remove(entry.path)
+        except os.error:
+            onerror(os.remove, entry.path, sys.exc_info())
+    return folders
 
 
 def move(src, dst):
@@ -1043,12 +1043,8 @@ class fwbackupsApp(Adw.Application):
             table.set_sensitive(False)
         tables[active].set_sensitive(True)
 
-        # disable incremental for remote
-        if active == 1:
-            self.ui.backupset4IncrementalCheck.set_active(False)
-            self.ui.backupset4IncrementalCheck.set_sensitive(False)
-        elif not constants.MSWINDOWS:
-            self.ui.backupset4IncrementalCheck.set_sensitive(True)
+        # the availability of incremental rsync backups depends on the destination
+        self.ui.backupset4EngineRadio2.emit('toggled')
 
     def on_backupset2FolderBrowseButton_clicked(self, widget):
         """Open the file browser to choose a folder"""
@@ -1136,20 +1132,25 @@ class fwbackupsApp(Adw.Application):
 
     def on_backupset4EngineRadio2_toggled(self, widget):
         """Set the sensibility of Incremental"""
-        if self.ui.backupset4EngineRadio2.get_active() and not constants.MSWINDOWS and \
-           self.ui.backupset2DestinationTypeCombobox.get_active() != 1:
+        # tar archives can always be incremental. rsync backups can when uploaded
+        # to a remote host, or when the rsync program is available (not Windows)
+        if self.ui.backupset4EngineRadio1.get_active() or \
+           (self.ui.backupset4EngineRadio2.get_active() and
+                (self.ui.backupset2DestinationTypeCombobox.get_active() == 1 or not constants.MSWINDOWS)):
             self.ui.backupset4IncrementalCheck.set_sensitive(True)
         else:
             self.ui.backupset4IncrementalCheck.set_sensitive(False)
             self.ui.backupset4IncrementalCheck.set_active(False)
+        self.ui.backupset4IncrementalCheck.emit('toggled')
 
     def on_backupset4IncrementalCheck_toggled(self, widget):
-        """To Keep must be 0"""
-        if self.ui.backupset4IncrementalCheck.get_active():
-            self.ui.backupset4OldToKeepSpin.set_value(0.0)
-            self.ui.backupset4OldToKeepSpin.set_sensitive(False)
+        """Explain what To Keep means for incremental rsync backups"""
+        if self.ui.backupset4IncrementalCheck.get_active() and self.ui.backupset4EngineRadio2.get_active():
+            self.ui.backupset4OldToKeepSpin.set_tooltip_text(_('Old backups are kept as hard-linked snapshots which ' +
+                                                               'only use space for the files that changed. With 0, ' +
+                                                               'the last backup is updated in place.'))
         else:
-            self.ui.backupset4OldToKeepSpin.set_sensitive(True)
+            self.ui.backupset4OldToKeepSpin.set_tooltip_text(None)
 
     def on_backupset4CompressCheck_toggled(self, widget):
         """Unset the compression combo if not selected"""
@@ -1223,6 +1224,11 @@ class fwbackupsApp(Adw.Application):
         elif response == Gtk.ResponseType.YES:
             try:
                 os.remove(setPath)
+                # state kept for incremental backups
+                for extension in ['snapshot', 'manifest']:
+                    statePath = os.path.join(constants.SETLOC, "%s.%s" % (setName, extension))
+                    if os.path.exists(statePath):
+                        os.remove(statePath)
             except OSError as error:
                 message = _('An error occured while removing set `%(a)s\':\n%(b)s' % {'a': setName, 'b': error})
                 self.displayError(self.ui.main, _("Could not remove backup set '%s'") % setName, message)
@@ -1516,13 +1522,12 @@ class fwbackupsApp(Adw.Application):
         password = base64.b64decode(setConfig.get('Options', 'RemotePassword').encode('ascii')).decode('ascii')
         port = setConfig.get('Options', 'RemotePort')
         destination = setConfig.get('Options', 'RemoteFolder')
-        client, sftpClient = sftp.connect(host, username, password, port)
+        client, sftpClient = sftp.acquire(host, username, password, port)
         try:
             listing = sftpClient.listdir(destination)
             return listing
         finally:
-            sftpClient.close()
-            client.close()
+            sftp.release(client, sftpClient)
 
     def _populateDates(self, setName):
         """Populates restore1SetDateCombobox with the appropriate backup date entries"""
@@ -1579,7 +1584,7 @@ class fwbackupsApp(Adw.Application):
         listing.reverse()  # make newest first
         backupDates = []
         for entry in listing:
-            # fmt: Backup-SetName from Backup-Setname-2009-03-22_20-46[.tar[.gz|.bz2]]
+            # fmt: Backup-SetName from Backup-Setname-2009-03-22_20-46[.tar[.gz|.bz2|.zst]]
             if entry.startswith('%s-%s-' % (_('Backup'), setName)):
                 backupDates.append(entry)
         if backupDates == []:
@@ -1589,6 +1594,8 @@ class fwbackupsApp(Adw.Application):
                 engine = 'tar.gz'
             elif entry.endswith('tar.bz2'):
                 engine = 'tar.bz2'
+            elif entry.endswith('tar.zst'):
+                engine = 'tar.zst'
             elif entry.endswith('.tar'):
                 engine = 'tar'
             else:  # rsync
@@ -1653,7 +1660,7 @@ class fwbackupsApp(Adw.Application):
                 options["RemotePort"] = setConfig.get('Options', 'RemotePort')
                 remoteDestination = setConfig.get('Options', 'RemoteFolder')
                 options["RemoteSource"] = os.path.join(remoteDestination, backupName)
-                # RemoteSource is transferred to Destination before restoring begins
+                # RemoteSource is extracted, or transferred if a folder, to Destination
                 options["Source"] = os.path.join(options["Destination"], backupName)
             else:
                 localDestination = setConfig.get('Options', 'Destination')
@@ -1676,8 +1683,8 @@ class fwbackupsApp(Adw.Application):
             options["RemotePassword"] = base64.b64encode(self.ui.restore1PasswordEntry.get_text().encode('ascii')).decode('ascii')
             options["RemotePort"] = self.ui.restore1PortSpin.get_value_as_int()
             options["RemoteSource"] = self.ui.restore1PathEntry.get_text()
-            # RemoteSource is transferred to Destination before restoring begins
-            # Source is ignored for remote folders, as transfering the folder to local finishes the backup
+            # RemoteSource is extracted, or transferred if a folder, to Destination
+            # Source is ignored, as the archive is read straight from the server
             options["Source"] = os.path.join(options["Destination"], os.path.basename(options["RemoteSource"]))
         # Finally, save all information
         options["SourceType"] = sourceType
@@ -1707,10 +1714,10 @@ class fwbackupsApp(Adw.Application):
             if not filename:
                 self.displayInfo(self.ui.main, _('Restore source'), _('Please enter the location of the local archive.'))
                 return False
-            elif not filename.endswith('.tar') and not filename.endswith('.tar.gz') and not filename.endswith('.tar.bz2'):
+            elif not filename.endswith(('.tar', '.tar.gz', '.tar.bz2', '.tar.zst')):
                 self.displayInfo(self.ui.restore, _('Wrong file type'),
                                  _('The file you selected is not a supported archive.\n' +
-                                 'Supported archives types are tar with no, gzip or bzip2 compression.'))
+                                 'Supported archives types are tar with no, gzip, bzip2 or zstd compression.'))
                 return False
             if not self.saveRestoreConfiguration(restoreConfig):
                 return False
@@ -1980,9 +1987,6 @@ class fwbackupsApp(Adw.Application):
             self.ui.backupset4EngineRadio1.set_active(True)
         elif cron_is_custom == "rsync":
             self.ui.backupset4EngineRadio2.set_active(True)
-            y = setConf.get('Options', 'Incremental')
-            if y == '1' and not constants.MSWINDOWS:
-                self.ui.backupset4IncrementalCheck.set_active(True)
         elif cron_is_custom == "tar.gz":
             self.ui.backupset4EngineRadio1.set_active(True)
             self.ui.backupset4CompressCheck.set_active(True)
@@ -1991,9 +1995,15 @@ class fwbackupsApp(Adw.Application):
             self.ui.backupset4EngineRadio1.set_active(True)
             self.ui.backupset4CompressCheck.set_active(True)
             self.ui.backupset4CompressCombo.set_active(1)
+        elif cron_is_custom == "tar.zst":
+            self.ui.backupset4EngineRadio1.set_active(True)
+            self.ui.backupset4CompressCheck.set_active(True)
+            self.ui.backupset4CompressCombo.set_active(2)
         # This ensures that incremental is at the proper sensitivity even if rsync
         # wasn't clicked on/off
         self.ui.backupset4EngineRadio2.emit('toggled')
+        if setConf.get('Options', 'Incremental') == '1' and self.ui.backupset4IncrementalCheck.get_sensitive():
+            self.ui.backupset4IncrementalCheck.set_active(True)
         self.ui.backupset4OldToKeepSpin.set_value(float(setConf.get('Options', 'OldToKeep')))
         # Advanced entries
         self.ui.backupset5NiceScale.set_value(float(setConf.get('Options', 'Nice')))
@@ -2104,6 +2114,8 @@ class fwbackupsApp(Adw.Application):
                     engine += '.gz'
                 elif active == 1:
                     engine += '.bz2'
+                elif active == 2:
+                    engine += '.zst'
         elif self.ui.backupset4EngineRadio2.get_active():
             engine = 'rsync'
         options["Engine"] = engine
@@ -2118,6 +2130,9 @@ class fwbackupsApp(Adw.Application):
         # so the backup doesn't fail before it starts.
         if constants.UID != 0 and nice < 0:
             options["Nice"] = 0
+        # Keep any options which are only tuned in the configuration file itself
+        for option, value in setConf.getOptions().items():
+            options.setdefault(option, value)
         # Finally, save all the information
         setConf.save(paths, options, times)
         try:
@@ -2229,6 +2244,12 @@ class fwbackupsApp(Adw.Application):
                 if os.path.isfile(namepath):
                     try:
                         os.remove(namepath)
+                        # backups are named after the set, so incremental
+                        # backups start over
+                        for extension in ['snapshot', 'manifest']:
+                            statePath = os.path.join(constants.SETLOC, "%s.%s" % (name, extension))
+                            if os.path.exists(statePath):
+                                os.remove(statePath)
                         self.logger.logmsg('DEBUG', _("Renaming set `%(a)s' to `%(b)s" % {'a': name, 'b': newName}))
                     except IOError as error:
                         self.logger.logmsg('DEBUG', _("Renaming set `%(a)s' to `%(b)s failed: %(c)s" % {'a': name, 'b': newName, 'c': error}))
@@ -2426,6 +2447,8 @@ class fwbackupsApp(Adw.Application):
                     engine += '.gz'
                 elif active == 1:
                     engine += '.bz2'
+                elif active == 2:
+                    engine += '.zst'
         elif self.ui.main3EngineRadio2.get_active():
             engine = 'rsync'
         options["Engine"] = engine
@@ -17,9 +17,11 @@
 #  along with fwbackups; if not, write to the Free Software
 #  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 import base64
+import filecmp
 import os
 import random
 import sys
+import time
 
 from getpass import getpass
 
@@ -149,26 +151,119 @@ times = {}
 times["Custom"] = "False"
 times["Entry"] = "0 0 * 1 0"
 
-for destType in ["remote (ssh)", "local"]:
-  for engine in ["rsync", "tar", "tar.gz", "tar.bz2"]:
-    print(_("*** Running %(a)s backup with engine %(b)s" % {'a': destType, 'b': engine}))
-    options["DestinationType"] = destType
-    options["Engine"] = engine
-    SETPATH = os.path.join(TESTDIR, "backup-%s-%s.conf" % (destType, engine))
-    if os.path.exists(SETPATH):
-      os.remove(SETPATH)
-    setConf = config.BackupSetConf(SETPATH, create=True)
-    setConf.save(paths, options, times)
-    operation = backup.SetBackupOperation(SETPATH)
-    operation.logger.setPrintToo(True)
-    if not operation.start():
-      raise OperationError(_("Backup failed!"))
-    print('\n')
+# Incremental sets are backed up this many times: a full backup, then
+# incremental ones of the changes made to the source files in between
+INCREMENTAL_RUNS = 3
+
+
+def set_name(destType, engine, incremental):
+  if incremental:
+    return "backup-incremental-%s-%s" % (destType, engine)
+  return "backup-%s-%s" % (destType, engine)
+
+
+def change_source_files(run):
+  """Modifies, adds and deletes source files before incremental run `run'"""
+  os.remove(os.path.join(SOURCEDIR, "file%i" % (run - 1)))
+  write_file(os.path.join(SOURCEDIR, "file%i" % run), MEGABYTE_BYTES + run)
+  write_file(os.path.join(SOURCEDIR, "added-%i" % run), MEGABYTE_BYTES)
+  folder = os.path.join(SOURCEDIR, "folder-%i" % run)
+  os.mkdir(folder)
+  write_file(os.path.join(folder, "file"), MEGABYTE_BYTES)
+  if run > 1:
+    shutil_modded.rmtree(os.path.join(SOURCEDIR, "folder-%i" % (run - 1)))
+
+
+def wait_for_next_minute():
+  """Backups are named after the minute they were made in, so runs of a set
+  must be at least a minute apart"""
+  print(_("Waiting for the next minute..."))
+  time.sleep(61 - time.time() % 60)
+
+
+for incremental in [0, 1]:
+  options["Incremental"] = incremental
+  for run in range(INCREMENTAL_RUNS if incremental else 1):
+    if run:
+      change_source_files(run)
+      wait_for_next_minute()
+    for destType in ["remote (ssh)", "local"]:
+      for engine in ["rsync", "tar", "tar.gz", "tar.bz2", "tar.zst"]:
+        print(_("*** Running %(a)s backup with engine %(b)s" % {'a': destType, 'b': engine}))
+        options["DestinationType"] = destType
+        options["Engine"] = engine
+        SETPATH = os.path.join(TESTDIR, "%s.conf" % set_name(destType, engine, incremental))
+        if os.path.exists(SETPATH):
+          os.remove(SETPATH)
+        setConf = config.BackupSetConf(SETPATH, create=True)
+        setConf.save(paths, options, times)
+        operation = backup.SetBackupOperation(SETPATH)
+        operation.logger.setPrintToo(True)
+        if not operation.start():
+          raise OperationError(_("Backup failed!"))
+        print('\n')
+options["Incremental"] = 0
+
+# Old remote backups are removed after the remote folder was listed
+print(_("*** Running remote backup which removes an old backup"))
+setName = "backup-remote-prune"
+oldBackup = os.path.join(remotefolder, "%s-%s-%s" % (_("Backup"), setName, "2000-01-01_00-00"))
+client, sftpClient = sftp.connect(hostname, username, raw_password, port)
+try:
+  sftp.mkdir_p(sftpClient, os.path.join(oldBackup, "folder"))
+  fh = sftpClient.open(os.path.join(oldBackup, "folder", "file"), 'w')
+  fh.write("old")
+  fh.close()
+finally:
+  sftpClient.close()
+  client.close()
+options["DestinationType"] = "remote (ssh)"
+options["Engine"] = "rsync"
+options["OldToKeep"] = 0
+SETPATH = os.path.join(TESTDIR, "%s.conf" % setName)
+if os.path.exists(SETPATH):
+  os.remove(SETPATH)
+setConf = config.BackupSetConf(SETPATH, create=True)
+setConf.save(paths, options, times)
+operation = backup.SetBackupOperation(SETPATH)
+operation.logger.setPrintToo(True)
+if not operation.start():
+  raise OperationError(_("Backup failed!"))
+client, sftpClient = sftp.connect(hostname, username, raw_password, port)
+try:
+  if os.path.basename(oldBackup) in sftpClient.listdir(remotefolder):
+    raise OperationError(_("The old backup `%s' was not removed!") % oldBackup)
+finally:
+  sftpClient.close()
+  client.close()
+options["OldToKeep"] = 99
+print('\n')
 
 #
 # Restore
 #
 
+
+def check_restored(destination):
+  """Checks that the source files, as the last incremental run left them, were
+  restored somewhere under destination"""
+  suffix = SOURCEDIR.lstrip(os.sep)
+  for folder, subfolders, filenames in os.walk(destination):
+    if folder.endswith(suffix):
+      break
+  else:
+    raise OperationError(_("%s was not restored!") % SOURCEDIR)
+  comparison = filecmp.dircmp(SOURCEDIR, folder)
+  pending = [comparison]
+  while pending:
+    comparison = pending.pop()
+    # compare contents, not only sizes and modification times
+    match, mismatch, errors = filecmp.cmpfiles(comparison.left, comparison.right, comparison.common_files, shallow=False)
+    if comparison.left_only or comparison.right_only or comparison.funny_files or mismatch or errors:
+      raise OperationError(_("The restored files in %(a)s do not match %(b)s!") % {'a': comparison.right, 'b': comparison.left})
+    pending.extend(comparison.subdirs.values())
+
+
 # Remote set backups
 options = {}
 options["RemoteHost"] = hostname
@@ -177,33 +272,38 @@ options["RemotePort"] = 22
 options["RemoteUsername"] = username
 options["SourceType"] = "set"
 
-for engine in ["rsync", "tar", "tar.gz", "tar.bz2"]:
-  setName = "backup-remote (ssh)-%s" % engine
-  print(_("*** Running restore of remote test backup %s" % setName))
-  RESTOREPATH = os.path.join(TESTDIR, "restore-remote (ssh)-%s.conf" % engine)
-  SETPATH = os.path.join(TESTDIR, "%s.conf" % setName)
-  setConfig = config.BackupSetConf(SETPATH)
-  restoreConfig = config.RestoreConf(RESTOREPATH, create=True)
-  remoteFolder = setConfig.get("Options", "RemoteFolder")
-  client, sftpClient = sftp.connect(hostname, username, raw_password, port)
-  listing = sftpClient.listdir(remoteFolder)
-  sftpClient.close()
-  client.close()
-  for backupName in listing:
-    if backupName.startswith("%s-%s" % (_("Backup"), setName)):
-      options["RemoteSource"] = os.path.join(remoteFolder, backupName)
-      # Restore into a subdir with backup name
-      restoreDestination = os.path.join(DESTDIR_RESTORE, setName)
-      os.mkdir(restoreDestination)
-      options["Destination"] = restoreDestination
-      options["Source"] = os.path.join(restoreDestination, backupName)
-      break
-  restoreConfig.save(options)
-  operation = restore.RestoreOperation(RESTOREPATH)
-  operation.logger.setPrintToo(True)
-  if not operation.start():
-    raise OperationError(_("Restore failed!"))
-  print('\n')
+for incremental in [0, 1]:
+  for engine in ["rsync", "tar", "tar.gz", "tar.bz2", "tar.zst"]:
+    setName = set_name("remote (ssh)", engine, incremental)
+    print(_("*** Running restore of remote test backup %s" % setName))
+    RESTOREPATH = os.path.join(TESTDIR, "restore-%s.conf" % setName)
+    SETPATH = os.path.join(TESTDIR, "%s.conf" % setName)
+    setConfig = config.BackupSetConf(SETPATH)
+    restoreConfig = config.RestoreConf(RESTOREPATH, create=True)
+    remoteFolder = setConfig.get("Options", "RemoteFolder")
+    client, sftpClient = sftp.connect(hostname, username, raw_password, port)
+    listing = sftpClient.listdir(remoteFolder)
+    sftpClient.close()
+    client.close()
+    # the newest backup, which incremental archives restore by replaying
+    # their chain
+    for backupName in sorted(listing, reverse=True):
+      if backupName.startswith("%s-%s-" % (_("Backup"), setName)):
+        options["RemoteSource"] = os.path.join(remoteFolder, backupName)
+        # Restore into a subdir with backup name
+        restoreDestination = os.path.join(DESTDIR_RESTORE, setName)
+        os.mkdir(restoreDestination)
+        options["Destination"] = restoreDestination
+        options["Source"] = os.path.join(restoreDestination, backupName)
+        break
+    restoreConfig.save(options)
+    operation = restore.RestoreOperation(RESTOREPATH)
+    operation.logger.setPrintToo(True)
+    if not operation.start():
+      raise OperationError(_("Restore failed!"))
+    if incremental:
+      check_restored(restoreDestination)
+    print('\n')
 
 # Local set backups
 options = {}
@@ -213,26 +313,29 @@ options["RemotePort"] = 22
 options["RemoteUsername"] = ''
 options["RemoteSource"] = ''
 options["SourceType"] = "set"
-for engine in ["rsync", "tar", "tar.gz", "tar.bz2"]:
-  setName = "backup-local-%s" % engine
-  print(_("*** Running restore of local test backup %s" % setName))
-  RESTOREPATH = os.path.join(TESTDIR, "restore-local-%s.conf" % engine)
-  restoreConfig = config.RestoreConf(RESTOREPATH, create=True)
-  listing = os.listdir(DESTDIR_BACKUP)
-  for backupName in listing:
-    if backupName.startswith("%s-%s" % (_("Backup"), setName)):
-      # Restore into a subdir with backup name
-      restoreDestination = os.path.join(DESTDIR_RESTORE, setName)
-      os.mkdir(restoreDestination)
-      options["Destination"] = restoreDestination
-      options["Source"] = os.path.join(DESTDIR_BACKUP, backupName)
-      break
-  restoreConfig.save(options)
-  operation = restore.RestoreOperation(RESTOREPATH)
-  operation.logger.setPrintToo(True)
-  if not operation.start():
-    raise OperationError(_("Restore failed!"))
-  print('\n')
+for incremental in [0, 1]:
+  for engine in ["rsync", "tar", "tar.gz", "tar.bz2", "tar.zst"]:
+    setName = set_name("local", engine, incremental)
+    print(_("*** Running restore of local test backup %s" % setName))
+    RESTOREPATH = os.path.join(TESTDIR, "restore-%s.conf" % setName)
+    restoreConfig = config.RestoreConf(RESTOREPATH, create=True)
+    listing = os.listdir(DESTDIR_BACKUP)
+    for backupName in sorted(listing, reverse=True):
+      if backupName.startswith("%s-%s-" % (_("Backup"), setName)):
+        # Restore into a subdir with backup name
+        restoreDestination = os.path.join(DESTDIR_RESTORE, setName)
+        os.mkdir(restoreDestination)
+        options["Destination"] = restoreDestination
+        options["Source"] = os.path.join(DESTDIR_BACKUP, backupName)
+        break
+    restoreConfig.save(options)
+    operation = restore.RestoreOperation(RESTOREPATH)
+    operation.logger.setPrintToo(True)
+    if not operation.start():
+      raise OperationError(_("Restore failed!"))
+    if incremental:
+      check_restored(restoreDestination)
+    print('\n')
 
 # Local archive
 print(_("*** Running restore of a local archive"))
@@ -271,7 +374,7 @@ options["RemotePort"] = 22
 options["RemoteUsername"] = ''
 options["RemoteSource"] = ''
 for item in os.listdir(DESTDIR_BACKUP):
-  if not item.endswith('.tar') and  not item.endswith('.tar.gz') and not item.endswith('.tar.bz2'):
+  if not item.endswith(('.tar', '.tar.gz', '.tar.bz2', '.tar.zst')):
     options["Source"] = os.path.join(DESTDIR_BACKUP, item)
     options["SourceType"] = "local folder"
     break